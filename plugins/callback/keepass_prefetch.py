@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+__metaclass__ = type
+
+import os
+
+from ansible.errors import AnsibleError
+from ansible.plugins.callback import CallbackBase
+from ansible.plugins.loader import lookup_loader
+from ansible.template import Templar
+
+DOCUMENTATION = """
+    name: keepass_prefetch
+    type: aggregate
+    short_description: Prefetch KeePass values at the start of a play
+    description:
+        - Fetches the C(keepass_prefetch) queries of the viczem.keepass.keepass
+          lookup by one request at the start of every play
+        - Ansible workers are forked from the controller process, so the
+          values are cached for all lookups of the play
+        - Variables of the first host of the play are used
+        - With C(keepass_backend=inprocess) the KeePass file is decrypted in
+          the controller, workers are forked with it and do not decrypt it
+    requirements:
+        - enable in configuration with
+          C(callbacks_enabled = viczem.keepass.keepass_prefetch)
+"""
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "viczem.keepass.keepass_prefetch"
+    CALLBACK_NEEDS_ENABLED = True
+
+    def v2_playbook_on_play_start(self, play):
+        variable_manager = play.get_variable_manager()
+        loader = play.get_loader()
+        if variable_manager is None or loader is None:
+            return
+
+        hosts = variable_manager._inventory.get_hosts(play.hosts)
+        variables = variable_manager.get_vars(
+            play=play, host=hosts[0] if hosts else None
+        )
+        backend = variables.get(
+            "keepass_backend", os.environ.get("ANSIBLE_KEEPASS_BACKEND", "socket")
+        )
+        if not variables.get("keepass_dbx") or (
+            not variables.get("keepass_prefetch") and backend != "inprocess"
+        ):
+            return
+
+        lookup = lookup_loader.get(
+            "viczem.keepass.keepass",
+            loader=loader,
+            templar=Templar(loader=loader, variables=variables),
+        )
+        try:
+            lookup.run(["prefetch"], variables)
+        except AnsibleError as e:
+            self._display.warning("KeePass: prefetch failed: %s" % e)
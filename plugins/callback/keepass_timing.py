@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+__metaclass__ = type
+
+import fcntl
+import json
+import os
+import tempfile
+
+from collections import defaultdict
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = """
+    name: keepass_timing
+    type: aggregate
+    short_description: Report time spent in KeePass lookups
+    description:
+        - Sums time of the viczem.keepass.keepass lookup per task, per host
+          and per entry path and prints the slowest ones at the end of every
+          play
+        - Time of a lookup is split into phases, C(vars) - templating of the
+          variables, C(connect) - starting of the socket, waiting for it and
+          connecting, C(request) - requests and responses, C(decode) -
+          decoding of responses
+        - Time of a lookup of several entries is split evenly between their
+          paths
+    requirements:
+        - enable in configuration with
+          C(callbacks_enabled = viczem.keepass.keepass_timing)
+    options:
+      top:
+        description: Number of the slowest tasks, hosts and paths printed
+        default: 10
+        type: int
+        env:
+          - name: ANSIBLE_KEEPASS_TIMING_TOP
+        ini:
+          - section: callback_keepass_timing
+            key: top
+      json_file:
+        description:
+          - Path of a JSON file the timings of all plays are written to at the
+            end of the playbook, e.g. to track them in CI
+        type: path
+        env:
+          - name: ANSIBLE_KEEPASS_TIMING_JSON
+        ini:
+          - section: callback_keepass_timing
+            key: json_file
+"""
+
+# Environment variable of the file lookups append their timings to, see
+# TIMINGS_ENV of the lookup
+TIMINGS_ENV = "ANSIBLE_KEEPASS_TIMINGS"
+PHASES = ("vars", "connect", "request", "decode")
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "viczem.keepass.keepass_timing"
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self._path = None
+        self._play = None
+        self._plays = []
+
+    def v2_playbook_on_start(self, playbook):
+        # workers are forked from this process and inherit the variable
+        fd, self._path = tempfile.mkstemp(prefix="ansible-keepass-timing-")
+        os.close(fd)
+        os.environ[TIMINGS_ENV] = self._path
+
+    def v2_playbook_on_play_start(self, play):
+        self._report()
+        self._play = play.get_name()
+
+    def v2_playbook_on_stats(self, stats):
+        self._report()
+        if self._path is not None:
+            os.environ.pop(TIMINGS_ENV, None)
+            os.unlink(self._path)
+            self._path = None
+
+        json_file = self.get_option("json_file")
+        if json_file:
+            with open(json_file, "w") as f:
+                json.dump({"plays": self._plays}, f, indent=2)
+
+    def _read(self):
+        """Read and clear the timings of lookups written since the last call"""
+        with open(self._path, "r+") as f:
+            # lookups append under a shared lock, none is lost in between
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lines = f.readlines()
+            f.truncate(0)
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a line of a killed worker
+                continue
+        return records
+
+    def _report(self):
+        """Print the timings of the play which has ended"""
+        if self._path is None or self._play is None:
+            return
+        records = self._read()
+        if not records:
+            return
+
+        tasks = defaultdict(_Total)
+        hosts = defaultdict(_Total)
+        paths = defaultdict(_Total)
+        phases = dict.fromkeys(PHASES, 0.0)
+        total = _Total()
+        for record in records:
+            seconds = record["seconds"]
+            task = record.get("task") or "(controller)"
+            # tasks of the same name, e.g. debug, differ by their path
+            tasks[(task, record.get("task_path"))].add(seconds, record)
+            hosts[record.get("host") or "(none)"].add(seconds, record)
+            for path in record.get("paths") or ():
+                paths[path].add(seconds / len(record["paths"]), record)
+            for phase in PHASES:
+                phases[phase] += record["phases"].get(phase, 0.0)
+            total.add(seconds, record)
+
+        play = {
+            "play": self._play,
+            "lookups": total.lookups,
+            "failed": total.failed,
+            "seconds": total.seconds,
+            "phases": phases,
+            "tasks": [
+                dict(name=name, path=path, **_.as_dict())
+                for (name, path), _ in tasks.items()
+            ],
+            "hosts": [dict(name=name, **_.as_dict()) for name, _ in hosts.items()],
+            "paths": [dict(name=name, **_.as_dict()) for name, _ in paths.items()],
+        }
+        self._plays.append(play)
+
+        top = self.get_option("top")
+        self._display.banner("KEEPASS LOOKUP TIME [%s]" % self._play)
+        self._display.display(
+            "%d lookups, %.3f seconds: %s"
+            % (
+                total.lookups,
+                total.seconds,
+                ", ".join("%s %.3f" % (_, phases[_]) for _ in PHASES),
+            )
+        )
+        for title in ("tasks", "hosts", "paths"):
+            rows = sorted(play[title], key=lambda _: _["seconds"], reverse=True)
+            self._display.display("%s:" % title.capitalize())
+            for row in rows[:top]:
+                name = row["name"]
+                if row.get("path"):
+                    name = "%s (%s)" % (name, row["path"])
+                self._display.display(
+                    "  %-60s %9.3fs %6d lookups"
+                    % (name, row["seconds"], row["lookups"])
+                )
+
+
+class _Total:
+    """Time and count of lookups"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.lookups = 0
+        self.failed = 0
+
+    def add(self, seconds, record):
+        self.seconds += seconds
+        self.lookups += 1
+        self.failed += 1 if record.get("failed") else 0
+
+    def as_dict(self):
+        return {"seconds": self.seconds, "lookups": self.lookups, "failed": self.failed}
@@ -1,23 +1,32 @@
 __metaclass__ = type
 
-import argparse
-import getpass
-import hashlib
 import fcntl
+import json
+import multiprocessing
 import os
-import re
+import select
 import socket
 import subprocess
 import sys
-import tempfile
 import time
 import traceback
 
+from collections import OrderedDict
+
 from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.plugins.lookup import LookupBase
 from ansible.utils.display import Display
-from pykeepass import PyKeePass
-from pykeepass.exceptions import CredentialsError
+
+try:
+    from ansible_collections.viczem.keepass.plugins.plugin_utils import keepass_socket
+except ImportError:
+    # keepass.py is started as a script to run the socket manually
+    sys.path.insert(
+        0,
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "plugin_utils"),
+    )
+    import keepass_socket
 
 DOCUMENTATION = """
     lookup: keepass
@@ -32,7 +41,38 @@ DOCUMENTATION = """
         description:
           - first is a path to KeePass entry
           - second is a property name of the entry, e.g. username or password
-        required: True
+          - or a single list (or dict) of such [path, property[, key]] queries,
+          - they are fetched by one request and returned as a list (or dict)
+        required: False
+      uuid:
+        description: find the entry with the UUID
+      title:
+        description: find entries with the title
+      tag:
+        description: find entries with the tag
+      url:
+        description: find entries with the URL or with the host name in the URL
+      path:
+        description: find entries with a path matching the regular expression
+      group:
+        description:
+          - export all entries of the group (path, "" - the root group) and its
+          - subgroups as a nested dict of "entries" by title and "groups" by name
+      depth:
+        description: depth of exported subgroups, 0 - entries of the group only
+        type: int
+      attachments:
+        description: export attachments of exported entries to files
+        type: bool
+        default: False
+      properties:
+        description:
+          - properties returned for every found entry along with its path,
+          - custom_properties is a dict, attachments is a list of file names
+          - (default for a group is username, password, url, notes and
+          - custom_properties)
+        type: list
+        default: [title, username, password, url]
     notes:
       - https://github.com/viczem/ansible-keepass
 
@@ -41,26 +81,76 @@ DOCUMENTATION = """
       - "{{ lookup('keepass', 'path/to/entry', 'password') }}"
       - "{{ lookup('keepass', 'path/to/entry', 'custom_properties', 'my_prop_name') }}"
       - "{{ lookup('keepass', 'path/to/entry', 'attachments', 'my_file_name') }}"
+      - "{{ lookup('keepass', [['path/to/entry', 'username'], ['entry', 'url']]) }}"
+      - "{{ lookup('keepass', {'user': ['path/to/entry', 'username']}) }}"
+      - "{{ lookup('keepass', tag='web', properties=['username', 'password']) }}"
+      - "{{ lookup('keepass', url='db.example.com') }}"
+      - "{{ lookup('keepass', path='^prod/.*/postgres$') }}"
+      - "{{ lookup('keepass', group='path/to/group', depth=1) }}"
+      - "{{ lookup('keepass', 'stats') }}"
+      - "{{ lookup('keepass', 'prefetch') }}"
 """
 
 display = Display()
 
+# Seconds to wait for a started socket to decrypt the KeePass file
+STARTUP_TIMEOUT = 60
+# Seconds a failed start of the socket fails lookups of workers of the same
+# controller instead of starting it again
+SPAWN_FAILURE_SECONDS = 10
+
+# File the keepass_timing callback reads timings of lookups from, set by the
+# callback in the controller and inherited by workers
+TIMINGS_ENV = "ANSIBLE_KEEPASS_TIMINGS"
+TIMING_PHASES = ("vars", "connect", "request", "decode")
+
+_MISSING = object()
+
 
 class LookupModule(LookupBase):
+    # KeePass files decrypted by the inprocess backend, shared by all lookups
+    # of the process
     keepass = None
 
     def _var(self, var_value):
         return self._templar.template(var_value, fail_on_undefined=True)
 
     def run(self, terms, variables=None, **kwargs):
-        if not terms:
+        timings_path = os.environ.get(TIMINGS_ENV)
+        if not timings_path:
+            return self._run(terms, variables, None, **kwargs)
+
+        timing = _LookupTiming(timings_path)
+        failed = True
+        try:
+            result = self._run(terms, variables, timing, **kwargs)
+            failed = False
+            return result
+        finally:
+            timing.write(failed)
+
+    def _run(self, terms, variables, timing, **kwargs):
+        # Entries found by a field are returned with their properties, entries
+        # of a group are exported as a nested dict
+        search = export = None
+        if "group" in kwargs:
+            export = self._export_terms(terms, kwargs)
+        elif kwargs:
+            search = self._search_terms(terms, kwargs)
+        elif not terms:
             raise AnsibleError("KeePass: arguments is not set")
-        if not all(isinstance(_, str) for _ in terms):
+        # A list or a dict of queries is fetched by one request
+        queries = None
+        if len(terms) == 1 and isinstance(terms[0], (list, dict)):
+            queries = terms[0]
+        elif not all(isinstance(_, str) for _ in terms):
             raise AnsibleError("KeePass: invalid argument type, all must be string")
 
         if variables is not None:
             self._templar.available_variables = variables
         variables_ = getattr(self._templar, "_available_variables", {})
+        if timing is not None:
+            timing.describe(variables_, terms, queries, search, export)
 
         # Check keepass database file (required)
         var_dbx = self._var(variables_.get("keepass_dbx", ""))
@@ -89,391 +179,1091 @@ class LookupModule(LookupBase):
         if not var_key and not var_psw:
             raise AnsibleError("KeePass: 'keepass_psw' and/or 'keepass_key' is not set")
 
+        # Where the file is decrypted (optional, default: socket): "socket" - once
+        # by a socket process serving all lookups, "inprocess" - once by every
+        # process running lookups, without a socket
+        default_backend = os.environ.get("ANSIBLE_KEEPASS_BACKEND", "socket")
+        var_backend = self._var(str(variables_.get("keepass_backend", default_backend)))
+        if var_backend not in ("socket", "inprocess"):
+            raise AnsibleError("KeePass: 'keepass_backend' must be socket or inprocess")
+
         # TTL of keepass socket (optional, default: 60 seconds)
         default_ttl = "60"
         if "ANSIBLE_KEEPASS_TTL" in os.environ:
             default_ttl = os.environ.get("ANSIBLE_KEEPASS_TTL")
         var_ttl = self._var(str(variables_.get("keepass_ttl", default_ttl)))
+        try:
+            if int(var_ttl) < 0:
+                raise ValueError(var_ttl)
+        except ValueError:
+            raise AnsibleError("KeePass: 'keepass_ttl' must be a non-negative integer")
+
+        # Lifetime of keepass socket (optional, default: ttl): "ttl" - until it
+        # is not used for keepass_ttl, "controller" - until the Ansible
+        # controller process exits, or a PID of a process to exit with
+        default_lifetime = os.environ.get("ANSIBLE_KEEPASS_LIFETIME", "ttl")
+        var_lifetime = self._var(
+            str(variables_.get("keepass_lifetime", default_lifetime))
+        )
+        parent_pid = None
+        if var_lifetime == "controller":
+            parent_pid = _controller_pid()
+        elif var_lifetime != "ttl":
+            try:
+                parent_pid = int(var_lifetime)
+            except ValueError:
+                raise AnsibleError(
+                    "KeePass: 'keepass_lifetime' must be ttl, controller or a PID"
+                )
+        if parent_pid is not None:
+            # the socket and decrypted files are not closed when not used
+            var_ttl = "0"
+
+        # Maximum lifetime of keepass socket in seconds (optional)
+        default_max_lifetime = os.environ.get("ANSIBLE_KEEPASS_MAX_LIFETIME", "")
+        var_max_lifetime = self._var(
+            str(variables_.get("keepass_max_lifetime", default_max_lifetime))
+        )
+
+        # Worker threads and queue of pending connections of keepass socket
+        # (optional, default: DEFAULT_WORKERS and DEFAULT_BACKLOG)
+        default_workers = os.environ.get("ANSIBLE_KEEPASS_WORKERS", "")
+        var_workers = self._var(str(variables_.get("keepass_workers", default_workers)))
+        default_backlog = os.environ.get("ANSIBLE_KEEPASS_BACKLOG", "")
+        var_backlog = self._var(str(variables_.get("keepass_backlog", default_backlog)))
+
+        # Interval of checks for changes of the KeePass file and the keyfile,
+        # a changed file is decrypted again (optional, default: DEFAULT_WATCH,
+        # 0 - disabled)
+        default_watch = os.environ.get("ANSIBLE_KEEPASS_WATCH", "")
+        var_watch = self._var(str(variables_.get("keepass_watch", default_watch)))
+
+        # Size limit of attachments exported by keepass socket in bytes
+        # (optional, default: DEFAULT_ATTACHMENT_CACHE)
+        default_attachment_cache = os.environ.get(
+            "ANSIBLE_KEEPASS_ATTACHMENT_CACHE", ""
+        )
+        var_attachment_cache = self._var(
+            str(variables_.get("keepass_attachment_cache", default_attachment_cache))
+        )
+
+        # One socket (daemon) for all KeePass files of the user instead of a
+        # socket per file (optional, default: false)
+        default_daemon = os.environ.get("ANSIBLE_KEEPASS_DAEMON", "false")
+        var_daemon = boolean(
+            self._var(str(variables_.get("keepass_daemon", default_daemon))),
+            strict=False,
+        )
+
+        # Keep only fields of entries and compressed attachments in memory of
+        # the socket instead of the whole decrypted file (optional, default:
+        # false)
+        default_compact = os.environ.get("ANSIBLE_KEEPASS_COMPACT", "false")
+        var_compact = boolean(
+            self._var(str(variables_.get("keepass_compact", default_compact))),
+            strict=False,
+        )
+
+        # Values of the file are mapped from a memfd of the socket and fetched
+        # without requests to the socket (optional, default: false)
+        default_shared_snapshot = os.environ.get(
+            "ANSIBLE_KEEPASS_SHARED_SNAPSHOT", "false"
+        )
+        var_shared_snapshot = boolean(
+            self._var(
+                str(variables_.get("keepass_shared_snapshot", default_shared_snapshot))
+            ),
+            strict=False,
+        )
+
+        # Prometheus textfile the socket writes its stats to (optional)
+        default_metrics_file = os.environ.get("ANSIBLE_KEEPASS_METRICS_FILE", "")
+        var_metrics_file = self._var(
+            str(variables_.get("keepass_metrics_file", default_metrics_file))
+        )
+
+        # Size of the cache of fetched values of a process (optional, default: 0 -
+        # disabled)
+        default_cache = os.environ.get("ANSIBLE_KEEPASS_CACHE", "0")
+        var_cache = self._var(str(variables_.get("keepass_cache", default_cache)))
+
+        # Queries fetched by one request on the first lookup (optional), they are
+        # cached for the process and the processes forked from it
+        var_prefetch = self._var(variables_.get("keepass_prefetch", []))
+
+        if timing is not None:
+            timing.end("vars")
+
+        if var_backend == "inprocess":
+            if LookupModule.keepass is None:
+                LookupModule.keepass = _InProcessKeePass()
+            return self._run_inprocess(
+                LookupModule.keepass,
+                (var_dbx, var_key or None, var_psw or None, var_compact),
+                terms,
+                queries,
+                search,
+                export,
+                timing,
+            )
 
-        socket_path = _keepass_socket_path(var_dbx)
+        try:
+            socket_path = keepass_socket.socket_path(None if var_daemon else var_dbx)
+        except PermissionError as e:
+            raise AnsibleError("KeePass: %s" % e)
         lock_file_ = socket_path + ".lock"
 
+        client = _KeePassClient.get(socket_path)
+        client.cache.maxsize = int(var_cache or 0)
+        # the password is sent to a just started socket along with the request
+        password = None
+        # the id of the KeePass file in a daemon and arguments to open it
+        database = None
+        if var_daemon:
+            database = (
+                keepass_socket.database_id(var_dbx, var_key or None),
+                [var_dbx, var_key or "", str(var_psw or ""), int(var_ttl)],
+            )
+
         try:
-            os.open(lock_file_, os.O_RDWR)
+            # the socket writes the generation of the decrypted file to the lock
+            # file, cached values of another generation are dropped
+            fd = os.open(lock_file_, os.O_RDONLY)
+            try:
+                client.cache.validate(int(os.read(fd, 32) or 0) or None)
+            finally:
+                os.close(fd)
+            if client.sock is None and not keepass_socket.locked(socket_path):
+                # left by a killed socket, start a new one
+                raise FileNotFoundError(lock_file_)
         except FileNotFoundError:
+            client.cache.validate(None)
             cmd = [
                 sys.executable,
-                os.path.abspath(__file__),
+                os.path.abspath(keepass_socket.__file__),
                 var_dbx,
                 socket_path,
                 var_ttl,
+                "--password-stdin",
             ]
             if var_key:
                 cmd.append("--key=%s" % var_key)
-            try:
-                display.v("KeePass: run socket for %s" % var_dbx)
-                subprocess.Popen(cmd)
-            except OSError:
-                os.remove(lock_file_)
-                raise AnsibleError(traceback.format_exc())
-
-            attempts = 10
-            success = False
-            for _ in range(attempts):
-                try:
-                    display.vvv("KeePass: try connect to socket %s/%s" % (_, attempts))
-                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                    sock.connect(socket_path)
-                    # send password to the socket for decrypt keepass dbx
-                    display.vvv("KeePass: send password to '%s'" % socket_path)
-                    sock.send(_rq("password", str(var_psw)))
-                    resp = sock.recv(1024).decode().splitlines()
-
-                    if len(resp) == 2 and resp[0] == "password":
-                        if resp[1] == "0":
-                            success = True
-                        else:
-                            raise AnsibleError("KeePass: wrong dbx password")
-                    sock.close()
-                    break
-                except FileNotFoundError:
-                    # wait until the above command open the socket
-                    time.sleep(1)
-
-            if not success:
-                raise AnsibleError("KeePass: socket connection failed for %s" % var_dbx)
-
+            if var_workers:
+                cmd.append("--workers=%s" % var_workers)
+            if var_backlog:
+                cmd.append("--backlog=%s" % var_backlog)
+            if var_watch:
+                cmd.append("--watch=%s" % var_watch)
+            if var_attachment_cache:
+                cmd.append("--attachment-cache=%s" % var_attachment_cache)
+            if var_daemon:
+                cmd.append("--daemon")
+            if var_compact:
+                cmd.append("--compact")
+            if parent_pid is not None:
+                cmd.append("--parent-pid=%d" % parent_pid)
+            if var_max_lifetime:
+                cmd.append("--max-lifetime=%s" % var_max_lifetime)
+            if var_metrics_file:
+                metrics_file = os.path.expanduser(os.path.expandvars(var_metrics_file))
+                cmd.append("--metrics-file=%s" % os.path.abspath(metrics_file))
+
+            client.close()
+            if not self._spawn_socket(cmd, str(var_psw), socket_path):
+                # the socket is started by another process, wait for it
+                self._wait_socket(client, socket_path, var_dbx)
+                # a daemon may serve another file, it is opened on demand
+                if database is None:
+                    password = str(var_psw)
             display.v("KeePass: open socket for %s -> %s" % (var_dbx, socket_path))
-
-        if len(terms) == 1 and terms[0] in ("quit", "exit", "close"):
-            self._send(socket_path, terms[0], [])
+            if timing is not None:
+                timing.end("connect")
+
+        if timing is not None:
+            timing.count(client)
+
+        prefetch_key = database[0] if database is not None else None
+        if var_prefetch and (
+            terms == ["prefetch"]
+            or client.cache.generation is None
+            or client.prefetched.get(prefetch_key) != client.cache.generation
+        ):
+            self._prefetch(client, var_prefetch, password, database)
+            password = None
+
+        # the snapshot is mapped once the socket has decrypted the file, it is
+        # mapped again when the generation in the lock file changes
+        snapshot = None
+        if var_shared_snapshot and password is None and client.cache.generation:
+            snapshot = self._snapshot(client, database)
+
+        if export is not None:
+            query = _cache_key(("export", repr(export)), database)
+            value = client.cache.get(query)
+            if value is _MISSING:
+                records = self._send(client, "export", export, password, database)[0]
+                if timing is not None:
+                    timing.end(None)
+                value = keepass_socket.nest(records)
+                if timing is not None:
+                    timing.end("decode")
+                if not (len(export) > 3 and export[3]):
+                    client.cache.put(query, value, client.generation)
+            return [value]
+        elif search is not None:
+            query = _cache_key(("find",) + search, database)
+            value = client.cache.get(query)
+            if value is _MISSING:
+                value = self._send(client, "find", search, password, database)[0]
+                client.cache.put(query, value, client.generation)
+            return [value]
+        elif queries is not None:
+            return [self._mfetch(client, queries, password, database, snapshot)]
+        elif terms == ["prefetch"]:
+            return []
+        elif len(terms) == 1 and terms[0] in ("quit", "exit", "close"):
+            self._send(client, terms[0], [], password)
+            client.close()
+            client.cache.validate(None)
             return []
+        elif len(terms) == 1 and terms[0] == "stats":
+            return self._send(client, "stats", [], password)
         else:
             # Fetching data from the keepass socket
-            return self._send(socket_path, "fetch", terms)
+            query = _cache_key(terms, database)
+            value = client.cache.get(query)
+            if value is not _MISSING:
+                display.vvv("KeePass: fetch %s (cached)" % terms)
+                return [value]
+            if snapshot is not None:
+                value = snapshot.get(terms, _MISSING)
+                if value is not _MISSING:
+                    display.vvv("KeePass: fetch %s (shared snapshot)" % terms)
+                    return [value]
+            value = self._send(client, "fetch", terms, password, database)[0]
+            if _cacheable(terms):
+                client.cache.put(query, value, client.generation)
+            return [value]
+
+    def _run_inprocess(self, keepass, file_, terms, queries, search, export, timing):
+        """Serve a lookup from a KeePass file decrypted in this process
+
+        Attachments are not exported, files written by a worker process
+        would never be removed.
+
+        :param _InProcessKeePass keepass:
+        :param tuple file_: path, key file, password and compact mode
+        """
+        if len(terms) == 1 and terms[0] in ("quit", "exit", "close"):
+            keepass.close(*file_[:2])
+            return []
+        if (
+            (export is not None and len(export) > 3 and export[3])
+            or (len(terms) > 1 and terms[1] == "attachments")
+            or (
+                queries is not None
+                and any(
+                    len(_) > 1 and _[1] == "attachments"
+                    for _ in (
+                        queries.values() if isinstance(queries, dict) else queries
+                    )
+                    if isinstance(_, (list, tuple))
+                )
+            )
+        ):
+            raise AnsibleError(
+                "KeePass: attachments are not exported by the inprocess backend"
+            )
+
+        database = keepass.get(*file_)
+        index = database.index
+        if timing is not None:
+            timing.end("connect")
+        started = time.perf_counter()
+
+        if terms == ["prefetch"]:
+            # the file is decrypted for the processes forked from this one
+            return []
+        if len(terms) == 1 and terms[0] == "stats":
+            return [keepass.stats(*file_[:2])]
 
-    def _send(self, kp_soc, cmd, terms):
-        display.vvv("KeePass: connect to '%s'" % kp_soc)
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if queries is not None:
+            if isinstance(queries, dict):
+                names, items = list(queries.keys()), list(queries.values())
+            else:
+                names, items = None, list(queries)
+            for item in items:
+                if not isinstance(item, (list, tuple)) or not all(
+                    isinstance(_, str) for _ in item
+                ):
+                    raise AnsibleError(
+                        "KeePass: invalid query '%s', a list of strings is expected"
+                        % item
+                    )
+            results = _inprocess_result(
+                database,
+                "mfetch",
+                started,
+                *database.mfetch(index, *[list(_) for _ in items]),
+            )
+            errors = [payload for status, payload in results if status != 0]
+            if errors:
+                raise AnsibleError(
+                    "KeePass: 'mfetch' has errors: %s" % "; ".join(errors)
+                )
+            values = [payload for _, payload in results]
+            value = values if names is None else dict(zip(names, values))
+        elif search is not None:
+            value = _inprocess_result(
+                database, "find", started, *database.find(index, *search)
+            )
+        elif export is not None:
+            chunks = _inprocess_result(
+                database, "export", started, *database.export(index, *export)
+            )
+            try:
+                records = [_ for chunk in chunks for _ in chunk]
+            except Exception as e:
+                raise AnsibleError("KeePass: '%s' has error 'export'" % e)
+            if timing is not None:
+                timing.end("request")
+            value = keepass_socket.nest(records)
+            if timing is not None:
+                timing.end("decode")
+            return [value]
+        else:
+            value = str(
+                _inprocess_result(
+                    database, "fetch", started, *database.fetch(index, *terms)
+                )
+            )
+
+        if timing is not None:
+            timing.end("request")
+        return [value]
+
+    def _search_terms(self, terms, kwargs):
+        """Arguments of the find command from keyword arguments of the lookup
+
+        One of ``keepass_socket.SEARCH_FIELDS`` is the field and its value,
+        ``properties`` is an optional list of returned properties.
+        """
+        fields = [_ for _ in keepass_socket.SEARCH_FIELDS if _ in kwargs]
+        unknown = set(kwargs) - set(keepass_socket.SEARCH_FIELDS) - {"properties"}
+        if terms or unknown or len(fields) != 1:
+            raise AnsibleError(
+                "KeePass: one of %s is expected to find entries"
+                % ", ".join(keepass_socket.SEARCH_FIELDS)
+            )
+        value = kwargs[fields[0]]
+        properties = kwargs.get("properties", [])
+        if isinstance(properties, str):
+            properties = [properties]
+        if not isinstance(value, str) or not all(
+            isinstance(_, str) for _ in properties
+        ):
+            raise AnsibleError("KeePass: invalid argument type, all must be string")
+        return (fields[0], value) + tuple(properties)
+
+    def _export_terms(self, terms, kwargs):
+        """Arguments of the export command from keyword arguments of the lookup
+
+        ``group`` is the path of the group, ``properties``, ``depth`` and
+        ``attachments`` are optional.
+        """
+        unknown = set(kwargs) - {"group", "properties", "depth", "attachments"}
+        if terms or unknown:
+            raise AnsibleError(
+                "KeePass: only group, properties, depth and attachments are "
+                "expected to export a group"
+            )
+        group = kwargs["group"]
+        properties = kwargs.get("properties")
+        if isinstance(properties, str):
+            properties = [properties]
+        depth = kwargs.get("depth")
+        if not isinstance(group, str) or not (
+            properties is None or all(isinstance(_, str) for _ in properties)
+        ):
+            raise AnsibleError("KeePass: invalid argument type, all must be string")
+        try:
+            depth = None if depth is None else int(depth)
+        except (TypeError, ValueError):
+            raise AnsibleError("KeePass: depth must be an integer")
+        attachments = boolean(kwargs.get("attachments", False), strict=False)
+        return (
+            group,
+            None if properties is None else list(properties),
+            depth,
+            attachments,
+        )
+
+    def _spawn_socket(self, cmd, password, socket_path):
+        """Start the socket unless another process starts it
+
+        Only one process starts the socket at a time, the others wait until
+        it is ready and use it instead of starting their own.
+
+        :return: False if the socket is started by another process
+        """
+        started = time.monotonic()
+        # workers of the same controller start the socket with the same
+        # arguments, a start of one which has just failed would fail for the
+        # others too
+        key = "%d %s" % (_controller_pid(), json.dumps(cmd))
+        since = time.time_ns() - SPAWN_FAILURE_SECONDS * 10**9
+        fd = keepass_socket.spawn_lock(socket_path)
+        try:
+            failure = keepass_socket.spawn_failure(fd, key, since)
+            if failure is not None:
+                raise AnsibleError(failure)
+            if keepass_socket.locked(socket_path):
+                display.v(
+                    "KeePass: waited %.3f seconds for socket for %s started "
+                    "by another process" % (time.monotonic() - started, cmd[2])
+                )
+                return False
+            try:
+                return self._start_socket(cmd, password)
+            except AnsibleError as e:
+                keepass_socket.spawn_failed(fd, key, str(e))
+                raise
+        finally:
+            os.close(fd)
 
+    def _start_socket(self, cmd, password):
+        """Start the socket and wait until the KeePass file is decrypted
+
+        The password is passed to the socket through stdin, the socket
+        reports its status to a pipe as soon as it is ready.
+
+        :return: False if the socket is already started by another process
+        """
+        started = time.monotonic()
+        ready_r, ready_w = os.pipe()
         try:
-            sock.connect(kp_soc)
-        except FileNotFoundError:
-            raise AnsibleError("KeePass: '%s' is not found" % kp_soc)
+            display.v("KeePass: run socket for %s" % cmd[2])
+            proc = subprocess.Popen(
+                cmd + ["--ready-fd=%d" % ready_w],
+                stdin=subprocess.PIPE,
+                pass_fds=(ready_w,),
+            )
+        except OSError:
+            os.close(ready_r)
+            raise AnsibleError(traceback.format_exc())
+        finally:
+            os.close(ready_w)
 
         try:
-            display.vvv("KeePass: %s %s" % (cmd, terms))
-            sock.send(_rq(cmd, *terms))
+            try:
+                proc.stdin.write(password.encode())
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
 
-            data = b''
+            status = b""
+            deadline = started + STARTUP_TIMEOUT
             while True:
-                _ = sock.recv(1024)
-                data += _
-                if len(_) < 1024:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or not select.select([ready_r], [], [], timeout)[0]:
+                    raise AnsibleError(
+                        "KeePass: socket startup timeout for %s" % cmd[2]
+                    )
+                chunk = os.read(ready_r, 1024)
+                if not chunk:
                     break
+                status += chunk
+        finally:
+            os.close(ready_r)
 
-            resp = data.decode().splitlines()
-            resp_len = len(resp)
-            if resp_len == 0:
-                raise AnsibleError("KeePass: '%s' result is empty" % cmd)
-
-            if resp_len >= 3:
-                if resp[0] != cmd:
+        if not status:
+            # the socket exits without a status if another one holds the lock,
+            # with an error code if it fails before it can report, e.g. on
+            # invalid arguments
+            try:
+                code = proc.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                raise AnsibleError("KeePass: socket startup timeout for %s" % cmd[2])
+            if code != 0:
+                raise AnsibleError(
+                    "KeePass: socket for %s exited with code %d" % (cmd[2], code)
+                )
+            return False
+
+        code, _, message = status.decode().partition(" ")
+        if code != "0":
+            # the socket exits right after it reports a failure
+            try:
+                proc.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                pass
+            raise AnsibleError("KeePass: %s" % message)
+
+        display.vvv(
+            "KeePass: socket for %s is ready in %.3f seconds"
+            % (cmd[2], time.monotonic() - started)
+        )
+        return True
+
+    def _wait_socket(self, client, socket_path, var_dbx):
+        started = time.monotonic()
+        deadline = started + STARTUP_TIMEOUT
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                client.connect()
+                display.v(
+                    "KeePass: connected to socket for %s started by another "
+                    "process in %d attempts, %.3f seconds"
+                    % (var_dbx, attempts, time.monotonic() - started)
+                )
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not keepass_socket.locked(socket_path):
                     raise AnsibleError(
-                        "KeePass: received command '%s', expected '%s'" % (resp[0], cmd)
+                        "KeePass: socket for %s is not running" % var_dbx
                     )
-                if resp[1] == "0":
-                    return [os.linesep.join(resp[2:])]
-                else:
-                    raise AnsibleError("KeePass: '%s' has error '%s'" % (resp[2], cmd))
+                if time.monotonic() > deadline:
+                    raise AnsibleError(
+                        "KeePass: socket connection failed for %s after %d "
+                        "attempts" % (var_dbx, attempts)
+                    )
+                time.sleep(0.1)
+
+    def _send(self, client, cmd, terms, password=None, database=None):
+        """Send a request over the connection of the process
+
+        :param _KeePassClient client:
+        :param str cmd: Command name
+        :param list terms: Arguments
+        :param str password: send the password first (pipelined)
+        :param tuple database: id and open arguments of the file in a daemon
+        """
+        request = (cmd, *terms)
+        if database is not None:
+            request = ("db", database[0]) + request
+        requests = [request]
+        if password is not None:
+            display.vvv("KeePass: send password to '%s'" % client.sock_path)
+            requests.insert(0, ("password", password))
+
+        try:
+            display.vvv("KeePass: %s %s" % (cmd, terms))
+            responses = client.request(*requests)
+
+            if password is not None:
+                resp = responses.pop(0)
+                if resp[0] != "password" or resp[1] != 0:
+                    raise AnsibleError("KeePass: wrong dbx password")
+
+            resp = responses[0]
+            if database is not None and resp and resp[0] == "open" and resp[1] != 0:
+                # the daemon does not serve the file yet, open it and repeat
+                display.vvv(
+                    "KeePass: open %s in '%s'" % (database[1][0], client.sock_path)
+                )
+                opened, resp = client.request(("open", *database[1]), request)
+                if opened[1] != 0:
+                    raise AnsibleError("KeePass: %s" % opened[2])
+
+            if not resp:
+                raise AnsibleError("KeePass: '%s' result is empty" % cmd)
 
+            resp_cmd, status, payload, client.generation = resp
+            if resp_cmd != cmd:
+                raise AnsibleError(
+                    "KeePass: received command '%s', expected '%s'" % (resp_cmd, cmd)
+                )
+            if status == 0:
+                return [payload]
+            else:
+                raise AnsibleError("KeePass: '%s' has error '%s'" % (payload, cmd))
+
+        except FileNotFoundError:
+            raise AnsibleError("KeePass: '%s' is not found" % client.sock_path)
         except Exception as e:
             raise AnsibleError(str(e))
+
+    def _prefetch(self, client, queries, password=None, database=None):
+        """Fetch queries by one request and keep them in the cache of the process
+
+        Processes forked later, e.g. Ansible workers forked after the
+        ``keepass_prefetch`` callback, inherit the values. A query which
+        fails is not cached, its lookup fails with the error.
+
+        :param list queries: ``[path, property[, key]]`` lists
+        """
+        if not isinstance(queries, (list, tuple)) or not all(
+            isinstance(item, (list, tuple)) and all(isinstance(_, str) for _ in item)
+            for item in queries
+        ):
+            raise AnsibleError(
+                "KeePass: 'keepass_prefetch' must be a list of lists of strings"
+            )
+
+        started = time.monotonic()
+        results = self._send(
+            client, "mfetch", [list(_) for _ in queries], password, database
+        )[0]
+        fetched = 0
+        for query, (status, payload) in zip(queries, results):
+            if status == 0:
+                fetched += 1
+                if _cacheable(query):
+                    key = _cache_key(query, database)
+                    client.cache.pin(key, payload, client.generation)
+            else:
+                display.vvv("KeePass: prefetch %s failed: %s" % (query, payload))
+        client.prefetched[database[0] if database is not None else None] = (
+            client.generation
+        )
+        display.vvv(
+            "KeePass: prefetched %d of %d values in %.3f seconds"
+            % (fetched, len(queries), time.monotonic() - started)
+        )
+
+    def _snapshot(self, client, database=None):
+        """Shared snapshot of the generation of the lock file
+
+        :param _KeePassClient client:
+        :param tuple database: id and open arguments of the file in a daemon
+        :return: ``keepass_socket.SharedSnapshot`` or None if the socket does
+            not support it
+        """
+        key = database[0] if database is not None else None
+        snapshot = client.snapshots.get(key)
+        if snapshot is False:
+            return None
+        if snapshot is not None:
+            if snapshot.generation == client.cache.generation:
+                return snapshot
+            snapshot.close()
+            del client.snapshots[key]
+        if not hasattr(socket, "recv_fds"):
+            # file descriptors are received by Python 3.9+
+            display.vvv("KeePass: shared snapshot is not used: no socket.recv_fds")
+            client.snapshots[key] = False
+            return None
+
+        # a shared snapshot is sent as a file descriptor
+        client.reader.receive_fds = True
+        try:
+            self._send(client, "snapshot", [], None, database)
+        except AnsibleError as e:
+            display.vvv("KeePass: shared snapshot is not used: %s" % e)
+            client.snapshots[key] = False
+            return None
         finally:
-            sock.close()
-            display.vvv("KeePass: disconnect from '%s'" % kp_soc)
+            if client.reader is not None:
+                client.reader.receive_fds = False
+            fds = client.reader.fds if client.reader is not None else []
+            received = fds[:]
+            del fds[:]
+        if not received:
+            client.snapshots[key] = False
+            return None
+        for fd in received[:-1]:
+            os.close(fd)
+        try:
+            snapshot = keepass_socket.SharedSnapshot(received[-1])
+        except (OSError, ValueError) as e:
+            display.vvv("KeePass: shared snapshot is not used: %s" % e)
+            client.snapshots[key] = False
+            return None
+        client.snapshots[key] = snapshot
+        display.vvv(
+            "KeePass: mapped shared snapshot of generation %d" % snapshot.generation
+        )
+        return snapshot
+
+    def _mfetch(self, client, queries, password=None, database=None, snapshot=None):
+        """Fetch a list or a dict of queries by one request
+
+        :param _KeePassClient client:
+        :param list|dict queries: ``[path, property[, key]]`` lists
+        :param str password: send the password first (pipelined)
+        :param tuple database: id and open arguments of the file in a daemon
+        :param keepass_socket.SharedSnapshot snapshot: values which are not
+            cached are read from it before they are requested
+        :return: values in a list, or in a dict with the keys of the queries
+        """
+        if isinstance(queries, dict):
+            names, items = list(queries.keys()), list(queries.values())
+        else:
+            names, items = None, list(queries)
+
+        for item in items:
+            if not isinstance(item, (list, tuple)) or not all(
+                isinstance(_, str) for _ in item
+            ):
+                raise AnsibleError(
+                    "KeePass: invalid query '%s', a list of strings is expected" % item
+                )
+
+        # only queries which are not cached are sent
+        values = [client.cache.get(_cache_key(_, database)) for _ in items]
+        if snapshot is not None:
+            values = [
+                snapshot.get(item, _MISSING) if value is _MISSING else value
+                for item, value in zip(items, values)
+            ]
+        missing = [_ for _, value in enumerate(values) if value is _MISSING]
+        if missing:
+            results = self._send(
+                client, "mfetch", [list(items[_]) for _ in missing], password, database
+            )[0]
+
+            errors = [payload for status, payload in results if status != 0]
+            if errors:
+                raise AnsibleError(
+                    "KeePass: 'mfetch' has errors: %s" % "; ".join(errors)
+                )
+
+            for i, (status, payload) in zip(missing, results):
+                values[i] = payload
+                if _cacheable(items[i]):
+                    client.cache.put(
+                        _cache_key(items[i], database), payload, client.generation
+                    )
+
+        if names is None:
+            return values
+        return dict(zip(names, values))
 
 
-def _keepass_socket(kdbx, kdbx_key, sock_path, ttl=60, kdbx_password=None):
+class _LookupTiming:
+    """Time of the phases of one lookup for the keepass_timing callback
+
+    ``vars`` is templating of the variables, ``connect`` starting of the
+    socket, waiting for it and connecting, ``request`` sending requests and
+    receiving responses, ``decode`` decoding of responses. The lookup is
+    appended as a JSON line to the file of ``TIMINGS_ENV``.
     """
 
-    :param str kdbx:
-    :param str kdbx_key:
-    :param str sock_path:
-    :param int ttl: in seconds
-    :return:
+    def __init__(self, path):
+        self.path = path
+        self.start = self.last = time.perf_counter()
+        self.phases = dict.fromkeys(TIMING_PHASES, 0.0)
+        self.host = None
+        self.paths = []
+        self._client = None
+        self._client_seconds = None
+
+    def describe(self, variables, terms, queries, search, export):
+        """Host and entry paths of the lookup"""
+        self.host = variables.get("inventory_hostname")
+        if export is not None:
+            self.paths = [export[0]]
+        elif search is not None:
+            self.paths = ["%s=%s" % search[:2]]
+        elif queries is not None:
+            items = queries.values() if isinstance(queries, dict) else queries
+            self.paths = [
+                _[0] for _ in items if isinstance(_, (list, tuple)) and _
+            ]
+        elif len(terms) > 1:
+            self.paths = [terms[0]]
+
+    def end(self, phase):
+        """Add the time since the end of the previous phase to a phase
+
+        :param str phase: None to skip the time
+        """
+        now = time.perf_counter()
+        if phase is not None:
+            self.phases[phase] += now - self.last
+        self.last = now
+
+    def count(self, client):
+        """Count time of requests of the client from now on"""
+        self._client = client
+        self._client_seconds = self._seconds(client)
+
+    @staticmethod
+    def _seconds(client):
+        return client.connect_seconds, client.request_seconds, client.decode_seconds
+
+    def write(self, failed=False):
+        if self._client is not None:
+            connect, request, decode = (
+                now - before
+                for now, before in zip(
+                    self._seconds(self._client), self._client_seconds
+                )
+            )
+            self.phases["connect"] += connect
+            self.phases["request"] += request - connect - decode
+            self.phases["decode"] += decode
+        task = getattr(multiprocessing.current_process(), "_task", None)
+        record = {
+            "host": self.host,
+            "task": task.get_name() if task is not None else None,
+            "task_uuid": getattr(task, "_uuid", None),
+            "task_path": task.get_path() if task is not None else None,
+            "paths": self.paths,
+            "phases": self.phases,
+            "seconds": time.perf_counter() - self.start,
+            "failed": failed,
+        }
+        try:
+            # the callback removes the file at the end of the playbook
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        except OSError:
+            return
+        try:
+            # the callback reads and truncates the file under an exclusive lock
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            # one write of a line per lookup, lines of workers do not mix
+            os.write(fd, (json.dumps(record) + "\n").encode())
+        finally:
+            os.close(fd)
+
 
-    Socket messages have multiline format.
-    First line is a command for both messages are request and response
+class _InProcessKeePass:
+    """KeePass files decrypted in the process of the lookups
+
+    A file is decrypted on its first lookup and again when it or its key
+    file changes. Processes forked later, e.g. Ansible workers forked after
+    a lookup in the controller, inherit the decrypted files.
     """
-    tmp_files = []
-    try:
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-            s.bind(sock_path)
-            s.listen(1)
-            if ttl > 0:
-                s.settimeout(ttl)
-            if kdbx_password:
-                kp = PyKeePass(kdbx, kdbx_password, kdbx_key)
-            else:
-                kp = None
-
-            is_open = True
-
-            while is_open:
-                conn, addr = s.accept()
-                with conn:
-                    if ttl > 0:
-                        conn.settimeout(ttl)
-                    while True:
-                        data = conn.recv(1024).decode()
-                        if not data:
-                            break
-
-                        rq = data.splitlines()
-                        if len(rq) == 0:
-                            conn.send(_resp("", 1, "empty request"))
-                            break
-
-                        cmd, *arg = rq
-                        arg_len = len(arg)
-
-                        # CMD: quit | exit | close
-                        if arg_len == 0 and cmd in ("quit", "exit", "close"):
-                            conn.send(_resp(cmd, 0))
-                            conn.close()
-                            is_open = False
-                            break
-
-                        # CMD: password
-                        if kp is None:
-                            if cmd == "password" and arg_len > 0:
-                                kp = PyKeePass(kdbx, arg[0], kdbx_key)
-                                conn.send(_resp("password", 0))
-                                break
-                            elif cmd == "password" and kdbx_key:
-                                kp = PyKeePass(kdbx, None, kdbx_key)
-                                conn.send(_resp("password", 0))
-                                break
-                            else:
-                                conn.send(_resp("password", 1))
-                                break
-                        elif cmd == "password":
-                            conn.send(_resp("password", 0))
-                            break
-
-                        # CMD: fetch
-                        # Read data from decrypted KeePass file
-                        if cmd != "fetch":
-                            conn.send(_resp("fetch", 1, "unknown command '%s'" % cmd))
-                            break
-
-                        if arg_len == 0:
-                            conn.send(_resp("fetch", 1, "path is not set"))
-                            break
-
-                        if arg_len == 1:
-                            conn.send(
-                                _resp(
-                                    "fetch",
-                                    1,
-                                    "property name is not set for '%s'" % arg[0],
-                                )
-                            )
-                            break
-
-                        path = [
-                            _.replace("\\/", "/")
-                            for _ in re.split(r"(?<!\\)/", arg[0])
-                            if _ != ""
-                        ]
-                        entry = kp.find_entries_by_path(path, first=True)
-
-                        if entry is None:
-                            conn.send(
-                                _resp("fetch", 1, "path '%s' is not found" % path)
-                            )
-                            break
-
-                        prop = arg[1]
-                        if prop == "custom_properties":
-                            if arg_len == 2:
-                                conn.send(
-                                    _resp(
-                                        "fetch",
-                                        1,
-                                        "no custom_property key for '%s'" % arg[0],
-                                    )
-                                )
-                                break
-
-                            prop_key = arg[2]
-                            if prop_key not in entry.custom_properties:
-                                conn.send(
-                                    _resp(
-                                        "fetch",
-                                        1,
-                                        "custom_property '%s' is not found for '%s'"
-                                        "" % (prop_key, path),
-                                    )
-                                )
-                                break
-                            conn.send(
-                                _resp(
-                                    "fetch",
-                                    0,
-                                    entry.get_custom_property(prop_key),
-                                )
-                            )
-                            break
-                        if prop == "attachments":
-                            if arg_len == 2:
-                                conn.send(
-                                    _resp(
-                                        "fetch",
-                                        1,
-                                        "attachment key is not set for '%s'" % arg[0],
-                                    )
-                                )
-                                break
-
-                            prop_key = arg[2]
-                            attachment = None
-                            for _ in entry.attachments:
-                                if _.filename == prop_key:
-                                    attachment = _
-                                    break
-                            if attachment is None:
-                                conn.send(
-                                    _resp(
-                                        "fetch",
-                                        1,
-                                        "attachment '%s' is not found "
-                                        "for '%s'" % (prop_key, path),
-                                    )
-                                )
-                                break
-
-                            tmp_file = tempfile.mkstemp(f".{attachment.filename}")[1]
-                            with open(tmp_file, "wb") as f:
-                                f.write(attachment.data)
-                            tmp_files.append(tmp_file)
-                            conn.send(_resp("fetch", 0, tmp_file))
-                            break
-
-                        if not hasattr(entry, prop):
-                            conn.send(
-                                _resp(
-                                    "fetch",
-                                    1,
-                                    "unknown property '%s' for '%s'" % (prop, path),
-                                )
-                            )
-                            break
-                        conn.send(_resp("fetch", 0, entry.deref(prop)))
-    except CredentialsError:
-        print("%s failed to decrypt" % kdbx)
-        sys.exit(1)
-    except FileNotFoundError as e:
-        print(str(e))
-        sys.exit(1)
-    except ValueError as e:
-        print(str(e))
-        sys.exit(1)
-    except socket.timeout:
-        pass
-    except KeyboardInterrupt:
-        pass
-    finally:
-        for tmp_file in tmp_files:
-            if os.path.exists(tmp_file):
-                os.remove(tmp_file)
-        if os.path.exists(sock_path):
-            os.remove(sock_path)
-
-        lock_file_ = sock_path + ".lock"
-        if os.path.isfile(lock_file_):
-            os.remove(lock_file_)
-
-
-def _rq(cmd, *arg):
-    """Request to keepass socket
-
-    :param str cmd: Command name
-    :param arg: Arguments
+
+    def __init__(self):
+        # (path, key file) -> keepass_socket.KeePassDatabase
+        self.databases = {}
+        # (path, key file) -> generation of the decryption, as of the socket
+        self.generations = {}
+
+    def get(self, dbx, key, password, compact=False):
+        database = self.databases.get((dbx, key))
+        if (
+            database is not None
+            and database.compact == compact
+            and not database.changed()
+        ):
+            database.last_used = time.monotonic()
+            return database
+
+        database = keepass_socket.KeePassDatabase(dbx, key, watch=0, compact=compact)
+        started = time.monotonic()
+        try:
+            database.unlock(password)
+        except keepass_socket.CredentialsError:
+            raise AnsibleError("KeePass: wrong dbx password")
+        except Exception as e:
+            raise AnsibleError("KeePass: %s" % e)
+        display.vvv(
+            "KeePass: decrypted %s in process %d in %.3f seconds"
+            % (dbx, os.getpid(), time.monotonic() - started)
+        )
+        self.databases[(dbx, key)] = database
+        self.generations[(dbx, key)] = time.time_ns()
+        return database
+
+    def stats(self, dbx, key):
+        """Stats of a decrypted file with the keys of the ``stats`` command"""
+        database = self.databases[(dbx, key)]
+        return keepass_socket.stats_payload(
+            database.stats,
+            {keepass_socket.database_id(dbx, key): database},
+            self.generations[(dbx, key)],
+            database.attachments,
+        )
+
+    def close(self, dbx, key):
+        self.databases.pop((dbx, key), None)
+        self.generations.pop((dbx, key), None)
+
+
+def _inprocess_result(database, cmd, started, status, payload):
+    """Payload of a command of the inprocess backend, as ``_send`` returns it
+
+    The command is counted in the stats of the file like a request to the
+    socket.
     """
-    return "\n".join((cmd, *arg)).encode()
+    database.stats.record(cmd, status, time.perf_counter() - started)
+    if status != 0:
+        raise AnsibleError("KeePass: '%s' has error '%s'" % (payload, cmd))
+    return payload
+
 
+def _controller_pid():
+    """PID of the Ansible controller, workers are forked from it"""
+    parent = multiprocessing.parent_process()
+    return parent.pid if parent is not None else os.getpid()
 
-def _resp(cmd, status_code, payload=""):
-    """Response from keepass socket
 
-    :param str cmd: Command name
-    :param int status_code: == 0 - no error; 1 - an error
-    :param payload: A data from keepass or error description
+def _cacheable(query):
+    """Whether a value of a query can be cached
+
+    Paths of attachments are not, the socket removes least recently fetched
+    files when its attachment cache is full.
     """
-    return "\n".join((cmd, str(status_code), str(payload))).encode()
+    return len(query) < 2 or query[1] != "attachments"
 
 
-def _keepass_socket_path(dbx_path):
-    # UNIX socket path for a dbx (supported multiple dbx)
-    if "ANSIBLE_KEEPASS_SOCKET" in os.environ:
-        return os.environ.get('ANSIBLE_KEEPASS_SOCKET')
-    # else:
-    tempdir = tempfile.gettempdir()
-    if not os.access(tempdir, os.W_OK):
-        raise AnsibleError("KeePass: no write permissions to '%s'" % tempdir)
+def _cache_key(query, database=None):
+    # a daemon serves several files, the cache of its connection too
+    if database is None:
+        return tuple(query)
+    return (database[0],) + tuple(query)
 
-    suffix = hashlib.sha1(("%s%s" % (getpass.getuser(), dbx_path)).encode()).hexdigest()
-    return "%s/ansible-keepass-%s.sock" % (tempdir, suffix[:8])
 
+class _ResultCache:
+    """LRU cache of fetched values of one generation of a KeePass file
 
-def lock(kdbx_sock_path):
-    fd = os.open(kdbx_sock_path + ".lock", os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+    The socket changes the generation when it decrypts the file, values of
+    a previous generation are never returned. Prefetched values are pinned,
+    they are not limited by ``maxsize``.
+    """
 
-    try:
-        # The LOCK_EX means that only one process can hold the lock
-        # The LOCK_NB means that the fcntl.flock() is not blocking
-        # https://docs.python.org/3/library/fcntl.html#fcntl.flock
-        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except (IOError, OSError):
-        return None
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.generation = None
+        self._values = OrderedDict()
+        self._pinned = {}
+
+    def validate(self, generation):
+        """Drop cached values if the generation has changed
+
+        :param int generation: current generation, None if it is unknown
+        """
+        if generation is None or generation != self.generation:
+            self._values.clear()
+            self._pinned.clear()
+        self.generation = generation
+
+    def get(self, query):
+        value = self._pinned.get(query, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = self._values.get(query, _MISSING)
+        if value is not _MISSING:
+            self._values.move_to_end(query)
+        return value
+
+    def pin(self, query, value, generation):
+        if generation is None:
+            return
+        self.validate(generation)
+        self._pinned[query] = value
+
+    def put(self, query, value, generation):
+        if self.maxsize <= 0 or generation is None:
+            return
+        self.validate(generation)
+        self._values[query] = value
+        self._values.move_to_end(query)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+
+
+class _KeePassClient:
+    """Connection to a keepass socket shared by all lookups of a process
+
+    The connection is opened on the first request and kept open, several
+    requests can be sent at once (pipelined), responses come in the same
+    order. A connection inherited from a parent process is not reused,
+    a dropped connection is reopened and the requests are sent again.
+    """
 
-    return fd
+    _clients = {}
+
+    def __init__(self, sock_path, cache=None):
+        self.sock_path = sock_path
+        self.pid = os.getpid()
+        self.sock = None
+        self.reader = None
+        # generation of the decrypted file of the last response
+        self.generation = None
+        self.cache = cache if cache is not None else _ResultCache()
+        # database id -> generation of prefetched values
+        self.prefetched = {}
+        # database id -> mapped shared snapshot, False if it is not supported
+        self.snapshots = {}
+        # time spent connecting, in requests (connecting and decoding included)
+        # and decoding responses
+        self.connect_seconds = 0.0
+        self.request_seconds = 0.0
+        self.decode_seconds = 0.0
+
+    @classmethod
+    def get(cls, sock_path):
+        client = cls._clients.get(sock_path)
+        if client is None:
+            client = cls._clients[sock_path] = cls(sock_path)
+        elif client.pid != os.getpid():
+            # cached values are inherited from the parent process
+            prefetched, snapshots = client.prefetched, client.snapshots
+            client = cls._clients[sock_path] = cls(sock_path, client.cache)
+            client.prefetched, client.snapshots = prefetched, snapshots
+        return client
+
+    def connect(self):
+        if self.sock is not None:
+            return
+        display.vvv("KeePass: connect to '%s'" % self.sock_path)
+        start = time.perf_counter()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.sock_path)
+        except OSError:
+            sock.close()
+            raise
+        finally:
+            self.connect_seconds += time.perf_counter() - start
+        self.sock = sock
+        self.reader = keepass_socket.FrameReader(sock)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+            display.vvv("KeePass: disconnect from '%s'" % self.sock_path)
+
+    def _read(self):
+        decode_seconds = self.reader.decode_seconds
+        resp = self.reader.read()
+        self.decode_seconds += self.reader.decode_seconds - decode_seconds
+        if resp is None:
+            raise ConnectionResetError("connection closed by the socket")
+        return resp
+
+    def request(self, *requests):
+        """Send requests and receive their responses
+
+        :param requests: tuples of a command name and arguments
+        :return: list of responses
+        """
+        start = time.perf_counter()
+        try:
+            return self._request(requests)
+        finally:
+            self.request_seconds += time.perf_counter() - start
+
+    def _request(self, requests):
+        for attempt in range(2):
+            self.connect()
+            try:
+                self.sock.sendall(b"".join(keepass_socket.rq(*_) for _ in requests))
+                responses = []
+                for _ in requests:
+                    resp = self._read()
+                    # a payload sent in chunks
+                    chunks = []
+                    while resp[1] == keepass_socket.STATUS_MORE:
+                        chunks.extend(resp[2])
+                        resp = self._read()
+                    if chunks and resp[1] == 0:
+                        resp[2] = chunks + resp[2]
+                    responses.append(resp)
+                return responses
+            except (OSError, keepass_socket.ProtocolError):
+                self.close()
+                if attempt > 0:
+                    raise
 
 
 if __name__ == "__main__":
-    arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument("kdbx", type=str)
-    arg_parser.add_argument("kdbx_sock", type=str, nargs="?", default=None)
-    arg_parser.add_argument("ttl", type=int, nargs="?", default=0)
-    arg_parser.add_argument("--key", type=str, nargs="?", default=None)
-    arg_parser.add_argument("--ask-pass", action="store_true")
-    args = arg_parser.parse_args()
-
-    arg_kdbx = os.path.realpath(os.path.expanduser(os.path.expandvars(args.kdbx)))
-    if args.key:
-        arg_key = os.path.realpath(os.path.expanduser(os.path.expandvars(args.key)))
-    else:
-        arg_key = None
-
-    if args.kdbx_sock:
-        arg_kdbx_sock = args.kdbx_sock
-    else:
-        arg_kdbx_sock = _keepass_socket_path(arg_kdbx)
-
-    password = None
-    if args.ask_pass:
-        password = getpass.getpass("Password: ")
-        if isinstance(password, bytes):
-            password = password.decode(sys.stdin.encoding)
-    elif "ANSIBLE_KEEPASS_PSW" in os.environ:
-        password = os.environ.get('ANSIBLE_KEEPASS_PSW')
-
-    arg_ttl = args.ttl
-    if arg_ttl is None and "ANSIBLE_KEEPASS_TTL" in os.environ:
-        arg_ttl = os.environ.get('ANSIBLE_KEEPASS_TTL')
-
-    os.umask(0o177)
-    if lock(arg_kdbx_sock):
-        _keepass_socket(arg_kdbx, arg_key, arg_kdbx_sock, arg_ttl, password)
+    keepass_socket.main()
@@ -11,6 +11,7 @@ from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils.basic import missing_required_lib
 from ansible.module_utils._text import to_bytes, to_native
 
+import hashlib
 import os
 import tempfile
 
@@ -34,6 +35,10 @@ author:
 short_description: Exports KeePass attachments
 description:
   - This module will export an attachment in a KeePass entry to a file.
+  - It can also export a list of attachments, all attachments of an entry or
+    all attachments of the entries of a group, the database is decrypted once.
+  - A file is only written when its content differs from the attachment, it
+    is written to a temporary file which is moved to the destination.
 
 version_added: "0.1.0"
 
@@ -53,24 +58,66 @@ options:
     description: Password for KeePass database file
     required: true
     type: str
+  keyfile:
+    description: Path to the key file of the KeePass database file
+    required: false
+    type: str
   entrypath:
-    description: Path to KeePass entry containing the attachment that should be exported
-    required: true
+    description:
+      - Path to KeePass entry containing the attachment that should be exported.
+      - All attachments of the entry are exported to the O(dest) directory
+        if O(attachment) is not set.
+    required: false
     type: str
   attachment:
     description: Name of attachment that should be exported
-    required: true
+    required: false
     type: str
-  dest:
-    description: Absolute path where the file should be exported to
-    required: true
+  grouppath:
+    description:
+      - Path to a KeePass group, C("") is the root group.
+      - All attachments of the entries of the group and its subgroups are
+        exported to C(<dest>/<subgroups>/<entry title>/<attachment>).
+    required: false
     type: str
+  dest:
+    description:
+      - Absolute path where the file should be exported to.
+      - A directory if O(attachment) is not set, missing directories are created.
+    required: false
+    type: path
+  attachments:
+    description:
+      - List of attachments exported by one invocation.
+      - File attributes of the module apply to every file, O(attachments[].mode)
+        overrides the mode of a file.
+    required: false
+    type: list
+    elements: dict
+    suboptions:
+      entrypath:
+        description: Path to KeePass entry containing the attachment
+        required: true
+        type: str
+      attachment:
+        description: Name of the attachment
+        required: true
+        type: str
+      dest:
+        description: Absolute path where the file should be exported to
+        required: true
+        type: path
+      mode:
+        description: Permissions of the file, see O(mode)
+        required: false
+        type: raw
 
 attributes:
   check_mode:
-    support: none
+    support: full
   diff_mode:
-    support: none
+    support: full
+    details: Only checksums of the content are shown, not the content itself.
   platform:
     platforms: posix
 """
@@ -84,20 +131,68 @@ EXAMPLES = r"""
     path: "group/subgroup/entry"
     attachment: somefile.txt
     dest: somefile_exported.txt
+
+# Export several files with one decryption of the database
+- name: Export certificates from KeePass
+  viczem.keepass.attachment:
+    database: database.kdbx
+    password: somepassword
+    attachments:
+      - entrypath: certs/web
+        attachment: web.crt
+        dest: /etc/ssl/certs/web.crt
+      - entrypath: certs/web
+        attachment: web.key
+        dest: /etc/ssl/private/web.key
+        mode: "0600"
+
+# Export all attachments of the entries of a group
+- name: Export all certificates from KeePass
+  viczem.keepass.attachment:
+    database: database.kdbx
+    password: somepassword
+    grouppath: certs
+    dest: /etc/keepass-certs
+    mode: "0600"
 """
 
-RETURN = r""" # """
+RETURN = r"""
+checksum:
+  description: SHA-256 checksum of the exported attachment
+  returned: success, when one attachment is exported
+  type: str
+  sample: 2852d7262f1fd6339a426560101d5840edf5b8999b90eb6b2eea86c8b9f7e298
+files:
+  description: Exported files with their entry path, attachment, checksum and change
+  returned: success, when a list, an entry or a group is exported
+  type: list
+  elements: dict
+  sample:
+    - dest: /etc/ssl/certs/web.crt
+      entrypath: certs/web
+      attachment: web.crt
+      checksum: 2852d7262f1fd6339a426560101d5840edf5b8999b90eb6b2eea86c8b9f7e298
+      changed: true
+changed_files:
+  description: Paths of the files which were written or whose attributes changed
+  returned: success, when a list, an entry or a group is exported
+  type: list
+  elements: str
+  sample: [/etc/ssl/certs/web.crt]
+"""
 
 
-def check_file_attrs(module, result, diff):
+def check_file_attrs(module, result, diff, path=None, mode=None):
 
     changed, msg = result["changed"], result["msg"]
 
-    file_args = module.load_file_common_arguments(module.params)
+    file_args = module.load_file_common_arguments(module.params, path=path)
+    if mode is not None:
+        file_args["mode"] = mode
     if module.set_fs_attributes_if_different(file_args, False, diff=diff):
 
-        if changed:
-            msg += " and "
+        if msg:
+            msg += " and " if changed else ", "
         changed = True
         msg += "ownership, perms or SE linux context changed"
 
@@ -107,66 +202,213 @@ def check_file_attrs(module, result, diff):
     return result
 
 
-def export_attachment(module, result):
-    try:
-        # load database
-        kp = PyKeePass(
-            module.params["database"],
-            password=module.params["password"],
-            keyfile=module.params["keyfile"])
+def find_entry(kp, entrypath):
+    return kp.find_entries(path=entrypath.split("/"), first=True)
+
+
+def entry_path(entry):
+    # a list of names since pykeepass 4, a string before
+    path = entry.path
+    return "/".join(path) if isinstance(path, list) else path
+
+
+def safe_name(name):
+    """A name of a file or directory from a title or a file name"""
+    name = name.replace("/", "_")
+    return "_" if name in ("", ".", "..") else name
+
+
+def group_items(module, kp, group_path, dest):
+    """Attachments of all entries of a group and its subgroups
+
+    An attachment is exported to ``dest/<subgroups>/<entry title>/<file>``.
+    """
+    if group_path in ("", "/"):
+        group = kp.root_group
+    else:
+        group = kp.find_groups(path=group_path.strip("/").split("/"), first=True)
+    if group is None:
+        module.fail_json(msg="Group '{0}' not found".format(group_path))
+
+    items = []
+    stack = [(group, [])]
+    while stack:
+        group, names = stack.pop()
+        for entry in group.entries:
+            entry_dir = os.path.join(dest, *(names + [safe_name(entry.title or "")]))
+            for item in entry.attachments:
+                items.append(
+                    dict(
+                        entry=entry,
+                        entrypath=entry_path(entry),
+                        attachment=item.filename,
+                        dest=os.path.join(entry_dir, safe_name(item.filename)),
+                        mode=None,
+                    )
+                )
+        for subgroup in reversed(group.subgroups):
+            stack.append((subgroup, names + [safe_name(subgroup.name or "")]))
+    return items
 
-        entrypath = module.params["entrypath"]
-        dest = module.params["dest"]
-        attachment = module.params["attachment"]
 
-        # find entry
-        kp_entry = kp.find_entries(path=entrypath.split("/"), first=True)
+def export_file(module, binaries, item, kp_attachment):
+    """Write an attachment to a file unless the file has the same content
 
-        if kp_entry is None:
-            module.fail_json(msg="Entry '{0}' not found".format(entrypath))
+    :return: dict of the dest, checksum, changed and diff of the file
+    """
+    dest = item["dest"]
+    b_data = binaries[kp_attachment.id]
+    checksum = hashlib.sha256(b_data).hexdigest()
 
-        kp_attachment = None
-        for item in kp_entry.attachments:
-            if item.filename == attachment:
-                kp_attachment = item
+    b_dest = os.path.realpath(to_bytes(dest, errors="surrogate_or_strict"))
+    dest_exists = os.path.exists(b_dest)
+    dest_checksum = module.sha256(b_dest) if dest_exists else None
 
-        if kp_attachment is None:
-            module.fail_json(
-                msg="Entry '{0}' does not contain attachment '{1}'".format(
-                    entrypath, attachment
-                )
+    file_result = dict(
+        dest=dest,
+        entrypath=item["entrypath"],
+        attachment=item["attachment"],
+        checksum=checksum,
+        changed=False,
+        diff=None,
+        exists=dest_exists,
+    )
+    if module._diff:
+        file_result["diff"] = dict(
+            before=dict(path=dest, checksum=dest_checksum),
+            after=dict(path=dest, checksum=checksum),
+        )
+
+    if dest_checksum != checksum:
+        if not module.check_mode:
+            b_dir = os.path.dirname(b_dest)
+            if not os.path.isdir(b_dir):
+                os.makedirs(b_dir)
+            # written next to dest, atomic_move renames it
+            tmpfd, tmpfile = tempfile.mkstemp(dir=b_dir)
+            f = os.fdopen(tmpfd, "wb")
+            f.write(b_data)
+            f.close()
+
+            module.atomic_move(
+                to_native(tmpfile, errors="surrogate_or_strict"),
+                to_native(b_dest, errors="surrogate_or_strict"),
+                unsafe_writes=module.params["unsafe_writes"],
             )
+            file_result["exists"] = True
+        file_result["changed"] = True
+    return file_result
 
-        b_data = kp_attachment.binary
 
-        tmpfd, tmpfile = tempfile.mkstemp()
-        f = os.fdopen(tmpfd, "wb")
-        f.write(b_data)
-        f.close()
+def export_attachments(module, result, items, grouppath=None):
+    """Export attachments of one decryption of the database
 
-        module.atomic_move(
-            tmpfile,
-            to_native(
-                os.path.realpath(to_bytes(dest, errors="surrogate_or_strict")),
-                errors="surrogate_or_strict",
-            ),
-            unsafe_writes=module.params["unsafe_writes"],
-        )
+    :param list items: dicts of entrypath, attachment, dest and mode, all
+        attachments of the group at ``grouppath`` are exported if it is set
+    """
+    single = module.params["attachments"] is None and grouppath is None and (
+        module.params["attachment"] is not None
+    )
+    files = []
+    try:
+        # load database
+        kp = PyKeePass(
+            module.params["database"],
+            password=module.params["password"],
+            keyfile=module.params["keyfile"])
 
-        result["changed"] = True
-        result["msg"] = "attachment '{0}' exported to file '{1}'".format(
-            module.params["attachment"], dest
-        )
+        if grouppath is not None:
+            items = group_items(module, kp, grouppath, module.params["dest"])
+
+        # binaries are decoded once, not per attachment
+        binaries = kp.binaries
+        entries = {}
+        for item in items:
+            entrypath = item["entrypath"]
+            kp_entry = item.get("entry")
+            if kp_entry is None:
+                if entrypath not in entries:
+                    entries[entrypath] = find_entry(kp, entrypath)
+                kp_entry = entries[entrypath]
+            if kp_entry is None:
+                module.fail_json(msg="Entry '{0}' not found".format(entrypath))
+
+            if item["attachment"] is None:
+                # all attachments of the entry to the dest directory
+                attachments = [
+                    dict(
+                        item,
+                        attachment=_.filename,
+                        dest=os.path.join(item["dest"], safe_name(_.filename)),
+                    )
+                    for _ in kp_entry.attachments
+                ]
+                kp_attachments = list(kp_entry.attachments)
+            else:
+                kp_attachment = None
+                for _ in kp_entry.attachments:
+                    if _.filename == item["attachment"]:
+                        kp_attachment = _
+                if kp_attachment is None:
+                    module.fail_json(
+                        msg="Entry '{0}' does not contain attachment '{1}'".format(
+                            entrypath, item["attachment"]
+                        )
+                    )
+                attachments = [item]
+                kp_attachments = [kp_attachment]
+
+            for attachment, kp_attachment in zip(attachments, kp_attachments):
+                file_result = export_file(module, binaries, attachment, kp_attachment)
+                file_result["mode"] = attachment.get("mode")
+                files.append(file_result)
 
     except Exception as e:
         result["msg"] = "Module viczem.keepass.attachment failed: {0}".format(e)
         module.fail_json(**result)
 
-    attr_diff = None
-
-    result = check_file_attrs(module, result, attr_diff)
-
-    module.exit_json(**result, diff=attr_diff)
+    if single:
+        file_result = files[0]
+        attachment, dest = file_result["attachment"], file_result["dest"]
+        result["checksum"] = file_result["checksum"]
+        result["changed"] = file_result["changed"]
+        if file_result["changed"]:
+            result["msg"] = "attachment '{0}' exported to file '{1}'".format(
+                attachment, dest
+            )
+        else:
+            result["msg"] = "attachment '{0}' is up to date in file '{1}'".format(
+                attachment, dest
+            )
+        attr_diff = file_result["diff"]
+        # attributes of a file which is not written in check mode are unknown
+        if file_result["exists"]:
+            result = check_file_attrs(module, result, attr_diff, dest)
+        module.exit_json(**result, diff=attr_diff)
+
+    diffs = []
+    for file_result in files:
+        if file_result["exists"]:
+            attrs = check_file_attrs(
+                module,
+                dict(changed=file_result["changed"], msg=""),
+                file_result["diff"],
+                file_result["dest"],
+                file_result["mode"],
+            )
+            file_result["changed"] = attrs["changed"]
+        if file_result["diff"] is not None:
+            diffs.append(file_result["diff"])
+        for key in ("diff", "exists", "mode"):
+            del file_result[key]
+
+    result["files"] = files
+    result["changed_files"] = [_["dest"] for _ in files if _["changed"]]
+    result["changed"] = bool(result["changed_files"])
+    result["msg"] = "{0} of {1} attachments exported".format(
+        len(result["changed_files"]), len(files)
+    )
+    module.exit_json(**result, diff=diffs)
 
 
 def main():
@@ -174,14 +416,37 @@ def main():
         database=dict(type="str", required=True),
         password=dict(type="str", no_log=True, required=True),
         keyfile=dict(type="str", no_log=True, required=False),
-        entrypath=dict(type="str", required=True),
-        attachment=dict(type="str", required=True),
-        dest=dict(type="path", required=True),
+        entrypath=dict(type="str", required=False),
+        attachment=dict(type="str", required=False),
+        grouppath=dict(type="str", required=False),
+        dest=dict(type="path", required=False),
+        attachments=dict(
+            type="list",
+            elements="dict",
+            required=False,
+            options=dict(
+                entrypath=dict(type="str", required=True),
+                attachment=dict(type="str", required=True),
+                dest=dict(type="path", required=True),
+                mode=dict(type="raw", required=False),
+            ),
+        ),
     )
 
     module = AnsibleModule(
         argument_spec=module_args,
         add_file_common_args=True,
+        supports_check_mode=True,
+        mutually_exclusive=[
+            ("attachments", "entrypath"),
+            ("attachments", "grouppath"),
+            ("entrypath", "grouppath"),
+            ("attachments", "dest"),
+            ("attachments", "attachment"),
+            ("grouppath", "attachment"),
+        ],
+        required_one_of=[("attachments", "entrypath", "grouppath")],
+        required_by=dict(entrypath="dest", grouppath="dest"),
     )
 
     if not HAS_LIB:
@@ -191,13 +456,31 @@ def main():
         changed=False,
     )
 
+    if module.params["attachments"] is not None:
+        items = module.params["attachments"]
+        export_attachments(module, result, items)
+
     dest = module.params["dest"]
     b_dest = to_bytes(dest, errors="surrogate_or_strict")
 
-    if os.path.isdir(b_dest):
-        module.fail_json(rc=256, msg="Destination {0} is a directory!".format(dest))
-
-    export_attachment(module, result)
+    if module.params["attachment"] is not None:
+        if os.path.isdir(b_dest):
+            module.fail_json(rc=256, msg="Destination {0} is a directory!".format(dest))
+    elif os.path.exists(b_dest) and not os.path.isdir(b_dest):
+        module.fail_json(rc=256, msg="Destination {0} is not a directory!".format(dest))
+
+    if module.params["grouppath"] is not None:
+        export_attachments(module, result, [], module.params["grouppath"])
+
+    items = [
+        dict(
+            entrypath=module.params["entrypath"],
+            attachment=module.params["attachment"],
+            dest=dest,
+            mode=None,
+        )
+    ]
+    export_attachments(module, result, items)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,2175 @@
+"""KeePass socket server
+
+Holds a decrypted KeePass file and serves requests of the lookup plugin over
+a UNIX socket. The module is started as a script by the lookup plugin, so it
+imports only the standard library and pykeepass.
+"""
+
+__metaclass__ = type
+
+import argparse
+import base64
+import bisect
+import ctypes
+import fcntl
+import getpass
+import hashlib
+import json
+import mmap
+import os
+import queue
+import re
+import resource
+import selectors
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+import zlib
+
+
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pykeepass import PyKeePass
+from pykeepass.entry import Entry, reserved_keys
+from pykeepass.exceptions import CredentialsError
+
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+DEFAULT_BACKLOG = 128
+DEFAULT_WATCH = 5
+DEFAULT_ATTACHMENT_CACHE = 256 * 1024 * 1024
+DEFAULT_METRICS_INTERVAL = 15
+# Interval of checks whether the parent process is alive if it cannot be
+# watched by a pidfd, in seconds
+PARENT_POLL_INTERVAL = 1
+
+# Commands counted by name in stats, others are counted as "unknown"
+COMMANDS = (
+    "fetch", "mfetch", "find", "export", "snapshot", "password", "open", "stats",
+    "quit", "exit", "close",
+)
+# Upper bounds in seconds of buckets of latency histograms
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5
+)
+# Number of most fetched paths returned by the stats command
+HOT_PATHS = 10
+
+# Socket protocol: every message is a frame of a header (magic, version of
+# the protocol, length of the body) and a JSON body. A response with the
+# status STATUS_MORE is a chunk of a list payload, it is followed by the
+# next frame of the same response.
+PROTOCOL_VERSION = 1
+STATUS_MORE = 2
+
+# Shared snapshot: a sealed memfd of a header (magic, generation, offset and
+# length of the index), values and a JSON index of the values
+SNAPSHOT_MAGIC = b"KPSNAP01"
+SNAPSHOT_HEADER = struct.Struct("!8sQQQ")
+FRAME_MAGIC = b"KP"
+FRAME_HEADER = struct.Struct("!2sBI")
+
+# Separator of groups in an entry path, "\/" is an escaped slash in a name
+PATH_SEPARATOR = re.compile(r"(?<!\\)/")
+
+# Field references "{REF:<wanted field>@<search field>:<search value>}"
+REFERENCE = re.compile(r"{REF:([TUPANI])@([TUPANI]):([^}]+)}")
+REFERENCE_FIELDS = {
+    "T": "Title",
+    "U": "UserName",
+    "P": "Password",
+    "A": "URL",
+    "N": "Notes",
+    "I": "UUID",
+}
+# Entry properties which can contain field references
+PROPERTY_FIELDS = {
+    "title": "Title",
+    "username": "UserName",
+    "password": "Password",
+    "url": "URL",
+    "notes": "Notes",
+}
+# Fields entries are found by with the find command, see ``KeePassIndex.search``
+SEARCH_FIELDS = ("uuid", "title", "tag", "url", "path")
+# Properties returned by the find command by default
+FIND_PROPERTIES = ("title", "username", "password", "url")
+# Properties of entries returned by the export command by default
+EXPORT_PROPERTIES = ("username", "password", "url", "notes", "custom_properties")
+# Number of records of the export command sent in one frame
+EXPORT_CHUNK = 500
+# Separators of tags of an entry
+TAG_SEPARATOR = re.compile(r"[;,]")
+# Host name of an URL "scheme://user@host:port/path"
+URL_HOST = re.compile(r"[a-zA-Z][a-zA-Z0-9+.-]*://(?:[^@/?#]*@)?(\[[^\]/]*\]|[^:/?#]*)")
+
+# Entry properties kept by a compact snapshot, see ``CompactEntry``
+COMPACT_PROPERTIES = (
+    "uuid",
+    "title",
+    "username",
+    "password",
+    "url",
+    "notes",
+    "tags",
+    "otp",
+)
+
+
+def serve(
+    kdbx,
+    kdbx_key,
+    sock_path,
+    ttl=60,
+    kdbx_password=None,
+    workers=None,
+    backlog=None,
+    ready_fd=None,
+    lock_fd=None,
+    watch=None,
+    attachment_cache=None,
+    metrics_file=None,
+    metrics_interval=None,
+    daemon=False,
+    compact=False,
+    parent_pid=None,
+    max_lifetime=None,
+):
+    """
+
+    :param str kdbx:
+    :param str kdbx_key:
+    :param str sock_path:
+    :param int ttl: in seconds
+    :param str kdbx_password: decrypt at startup, "" - with the key only
+    :param int workers: number of threads serving connections
+    :param int backlog: size of the queue of pending connections
+    :param int ready_fd: a pipe to write the startup status to
+    :param int lock_fd: the lock file to publish the generation to
+    :param int watch: interval of checks of changes of the file in seconds
+    :param int attachment_cache: size limit of exported attachments in bytes
+    :param str metrics_file: Prometheus textfile to write stats to
+    :param int metrics_interval: interval of writes of the metrics_file in seconds
+    :param bool daemon: serve other KeePass files too, see ``KeePassServer``
+    :param bool compact: keep only fields of entries, see ``KeePassIndex``
+    :param int parent_pid: serve until the process exits, e.g. the Ansible
+        controller, usually with ttl 0
+    :param int max_lifetime: exit after this number of seconds in any case
+    :return:
+
+    Socket messages are length-prefixed frames with a JSON list body.
+    First item is a command for both messages are request and response
+
+    When the socket is listening and the file is decrypted (if a password is
+    given) "0" is written to ``ready_fd``, on failure "1 <error>" is written,
+    then the pipe is closed.
+    """
+    server = KeePassServer(
+        kdbx,
+        kdbx_key,
+        ttl,
+        workers,
+        backlog,
+        lock_fd,
+        watch,
+        attachment_cache,
+        metrics_file,
+        metrics_interval,
+        daemon,
+        compact,
+        parent_pid,
+        max_lifetime,
+    )
+    error = None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            if os.path.exists(sock_path):
+                # left by a killed socket, this one holds the lock
+                os.remove(sock_path)
+            s.bind(sock_path)
+            s.listen(server.backlog)
+            if kdbx_password is not None:
+                server.database.unlock(kdbx_password or None)
+            notify_ready(ready_fd, 0)
+            # the pipe is closed, its number may be reused
+            ready_fd = None
+            server.serve(s)
+    except CredentialsError:
+        error = "wrong dbx password"
+        print("%s failed to decrypt" % kdbx)
+    except (FileNotFoundError, ValueError) as e:
+        error = str(e)
+        print(error)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        # e.g. a corrupt file or a failed bind
+        error = repr(e)
+        print(error)
+    finally:
+        server.cleanup()
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+
+        lock_file_ = sock_path + ".lock"
+        if os.path.isfile(lock_file_):
+            os.remove(lock_file_)
+
+    # reported once the files are removed, the lookup which started the
+    # socket lets other ones start it again as soon as it reads the status
+    if error is not None:
+        notify_ready(ready_fd, 1, error)
+        sys.exit(1)
+
+
+class KeePassServer:
+    """Serves requests to decrypted KeePass files from a pool of threads
+
+    The main thread waits for new connections and for requests on idle
+    connections, a connection with a request is handed to one of the worker
+    threads which answers all requests received on it (clients can pipeline
+    several requests) and then gives the connection back to the main thread.
+    So a connection is kept open between requests without holding a thread.
+
+    The server exits when it is not used for its TTL (0 - never), when the
+    parent process (``parent_pid``) exits or after ``max_lifetime``
+    seconds, whichever comes first.
+
+    A server serves the KeePass file it is started with. A daemon
+    (``daemon=True``) serves any number of KeePass files of a user: a file
+    is added and decrypted by the ``open`` command, requests to it are sent
+    as ``["db", <database id>, <command>, ...]`` and it is closed when it is
+    not used for its TTL.
+    """
+
+    def __init__(
+        self,
+        kdbx,
+        kdbx_key,
+        ttl=60,
+        workers=None,
+        backlog=None,
+        lock_fd=None,
+        watch=None,
+        attachment_cache=None,
+        metrics_file=None,
+        metrics_interval=None,
+        daemon=False,
+        compact=False,
+        parent_pid=None,
+        max_lifetime=None,
+    ):
+        self.ttl = ttl
+        self.workers = workers or DEFAULT_WORKERS
+        self.backlog = backlog or DEFAULT_BACKLOG
+        self.lock_fd = lock_fd
+        self.watch = DEFAULT_WATCH if watch is None else watch
+        self.daemon = daemon
+        self.compact = compact
+        self.parent_pid = parent_pid
+        self.max_lifetime = max_lifetime
+        self.generation = None
+        self.is_open = True
+        self.attachments = AttachmentStore(
+            DEFAULT_ATTACHMENT_CACHE if attachment_cache is None else attachment_cache
+        )
+        self.stats = ServerStats()
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval or DEFAULT_METRICS_INTERVAL
+        # database id -> KeePassDatabase
+        self.databases = {}
+        self._databases_lock = threading.Lock()
+        self._generation_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._last_activity = time.monotonic()
+        # connections given back by workers, the main thread is woken up
+        # by a byte written to the socket pair
+        self._idle = queue.SimpleQueue()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+        # the file the server is started with, requests without a database
+        # id are sent to it
+        self.database = None
+        if kdbx:
+            self.database = self._add_database(kdbx, kdbx_key, ttl if daemon else 0)
+
+    def serve(self, s):
+        self._started = self._last_activity = time.monotonic()
+        if self.metrics_file:
+            threading.Thread(
+                target=self._write_metrics_periodically,
+                name="keepass-metrics",
+                daemon=True,
+            ).start()
+        sel = selectors.DefaultSelector()
+        sel.register(s, selectors.EVENT_READ)
+        sel.register(self._wakeup_r, selectors.EVENT_READ)
+        # a pidfd of the parent process is readable when the process exits,
+        # without it the process is polled
+        self._parent_fd = None
+        if self.parent_pid:
+            if not self._parent_alive():
+                print("parent process %d is not running" % self.parent_pid)
+                sel.close()
+                return
+            try:
+                self._parent_fd = os.pidfd_open(self.parent_pid)
+                sel.register(self._parent_fd, selectors.EVENT_READ)
+            except (AttributeError, OSError):
+                self._parent_fd = None
+        parent_exited = False
+        # idle connection -> time of the last request
+        idle = {}
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="keepass"
+            ) as pool:
+                while self.is_open:
+                    for key, _ in sel.select(self._select_timeout()):
+                        if key.fileobj is s:
+                            conn, addr = s.accept()
+                            self._last_activity = time.monotonic()
+                            sel.register(conn, selectors.EVENT_READ, FrameReader(conn))
+                            idle[conn] = time.monotonic()
+                        elif key.fileobj is self._wakeup_r:
+                            self._wakeup_r.recv(4096)
+                        elif key.fileobj == self._parent_fd:
+                            parent_exited = True
+                        else:
+                            conn = key.fileobj
+                            sel.unregister(conn)
+                            del idle[conn]
+                            with self._active_lock:
+                                self._active += 1
+                            pool.submit(self._handle, conn, key.data)
+
+                    while not self._idle.empty():
+                        conn, reader = self._idle.get()
+                        if self.is_open:
+                            sel.register(conn, selectors.EVENT_READ, reader)
+                            idle[conn] = time.monotonic()
+                        else:
+                            conn.close()
+
+                    now = time.monotonic()
+                    if self.parent_pid and (
+                        parent_exited
+                        or self._parent_fd is None
+                        and not self._parent_alive()
+                    ):
+                        print("parent process %d has exited" % self.parent_pid)
+                        break
+                    if self.max_lifetime and now - self._started >= self.max_lifetime:
+                        print("maximum lifetime of %s seconds" % self.max_lifetime)
+                        break
+                    if self.daemon:
+                        self._close_idle_databases(now)
+                    if self.ttl > 0:
+                        for conn, last in list(idle.items()):
+                            if now - last >= self.ttl:
+                                sel.unregister(conn)
+                                del idle[conn]
+                                conn.close()
+                        # TTL is counted while there is no request in progress,
+                        # e.g. a long decryption is not a reason to close the socket
+                        if self._active == 0 and now - self._last_activity >= self.ttl:
+                            break
+        finally:
+            for conn in idle:
+                conn.close()
+            sel.close()
+            if self._parent_fd is not None:
+                os.close(self._parent_fd)
+
+    def _parent_alive(self):
+        try:
+            os.kill(self.parent_pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _select_timeout(self):
+        now = time.monotonic()
+        timeouts = []
+        if self.ttl > 0:
+            timeouts.append(min(self.ttl - (now - self._last_activity), self.ttl))
+        if self.parent_pid and self._parent_fd is None:
+            timeouts.append(PARENT_POLL_INTERVAL)
+        if self.max_lifetime:
+            timeouts.append(self.max_lifetime - (now - self._started))
+        if self.daemon:
+            for database in list(self.databases.values()):
+                if database.index is not None and database.ttl > 0:
+                    timeouts.append(database.ttl - (now - database.last_used))
+        if not timeouts:
+            return None
+        return max(0, min(timeouts))
+
+    def _add_database(self, kdbx, kdbx_key, ttl):
+        db_id = database_id(kdbx, kdbx_key)
+        with self._databases_lock:
+            database = self.databases.get(db_id)
+            if database is None:
+                database = self.databases[db_id] = KeePassDatabase(
+                    kdbx,
+                    kdbx_key,
+                    self.watch,
+                    ttl,
+                    self.attachments,
+                    self.stats,
+                    self._publish_generation,
+                    self.compact,
+                )
+        return database
+
+    def _close_idle_databases(self, now):
+        for database in list(self.databases.values()):
+            if (
+                database.index is not None
+                and database.ttl > 0
+                and now - database.last_used >= database.ttl
+            ):
+                database.close()
+
+    def _publish_generation(self):
+        """Change the generation of the served data
+
+        Called after a database is decrypted. Clients cache fetched values of
+        a generation, the generation is returned in every response and
+        written to the lock file, so clients can check it without a request
+        to the socket.
+        """
+        with self._generation_lock:
+            self.generation = time.time_ns()
+            if self.lock_fd is not None:
+                os.pwrite(self.lock_fd, b"%020d" % self.generation, 0)
+
+    def shutdown(self):
+        self.is_open = False
+        self._stopped.set()
+        self._wakeup()
+
+    def stats_payload(self):
+        """Stats of the server as returned by the ``stats`` command"""
+        return stats_payload(
+            self.stats, self.databases, self.generation, self.attachments
+        )
+
+    def write_metrics(self):
+        """Write stats to the Prometheus textfile atomically"""
+        tmp_path = "%s.%d.tmp" % (self.metrics_file, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(prometheus(self.stats_payload()))
+        # read by an exporter of another user, there are no secrets in it
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.metrics_file)
+
+    def _write_metrics_periodically(self):
+        while True:
+            try:
+                self.write_metrics()
+            except OSError as e:
+                print("%s: %s" % (self.metrics_file, e))
+            if self._stopped.wait(self.metrics_interval):
+                return
+
+    def cleanup(self):
+        self._stopped.set()
+        for database in list(self.databases.values()):
+            database.close()
+        if self.metrics_file:
+            try:
+                self.write_metrics()
+            except OSError:
+                pass
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        self.attachments.cleanup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _handle(self, conn, reader):
+        keep = False
+        try:
+            keep = self._serve_conn(conn, reader)
+        finally:
+            with self._active_lock:
+                self._active -= 1
+                self._last_activity = time.monotonic()
+            if keep:
+                self._idle.put((conn, reader))
+            else:
+                conn.close()
+            self._wakeup()
+
+    def _serve_conn(self, conn, reader):
+        """Answer requests received on a connection
+
+        :return: True if the connection is kept open for next requests
+        """
+        if self.ttl > 0:
+            conn.settimeout(self.ttl)
+        try:
+            while True:
+                try:
+                    rq = reader.read()
+                except ProtocolError as e:
+                    conn.sendall(resp("", 1, str(e)))
+                    return False
+                if rq is None:
+                    return False
+
+                if not isinstance(rq, list) or len(rq) == 0:
+                    conn.sendall(resp("", 1, "empty request"))
+                    return False
+
+                # a request to a database of a daemon is answered and counted
+                # by its command
+                cmd = rq[2] if rq[0] == "db" and len(rq) > 2 else rq[0]
+                start = time.perf_counter()
+                try:
+                    response = self._dispatch(*rq)
+                    if isinstance(response[2], types.GeneratorType):
+                        response = self._stream(conn, *response)
+                except Exception as e:
+                    response = (cmd, 1, str(e), None)
+                self.stats.record(cmd, response[1], time.perf_counter() - start)
+                if len(response) > 4:
+                    self._send_fds(conn, frame(response[:4]), response[4])
+                else:
+                    conn.sendall(frame(response))
+
+                # pipelined requests which are already received
+                if not reader.has_frame():
+                    return self.is_open
+        except (socket.timeout, OSError):
+            return False
+
+    def _stream(self, conn, cmd, status_code, chunks, generation):
+        """Send chunks of a payload as they are made
+
+        :return: the last response, an empty chunk or an error
+        """
+        for chunk in chunks:
+            conn.sendall(frame((cmd, STATUS_MORE, chunk, generation)))
+        return cmd, status_code, [], generation
+
+    def _send_fds(self, conn, data, fds):
+        """Send a frame with file descriptors, they are closed then"""
+        try:
+            sent = socket.send_fds(conn, [data], fds)
+            conn.sendall(data[sent:])
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _dispatch(self, cmd, *arg):
+        """Run a command
+
+        :return: response as a tuple of ``resp`` arguments, optionally with
+            a list of file descriptors sent along with the response
+        """
+        arg_len = len(arg)
+
+        # CMD: quit | exit | close
+        if arg_len == 0 and cmd in ("quit", "exit", "close"):
+            self.shutdown()
+            return cmd, 0, "", None
+
+        # CMD: stats
+        # Counters of the server, available before decryption
+        if arg_len == 0 and cmd == "stats":
+            return "stats", 0, self.stats_payload(), None
+
+        # CMD: open
+        # Add a KeePass file to a daemon and decrypt it
+        if cmd == "open" and self.daemon:
+            return self._open(*arg)
+
+        # CMD: db
+        # A request to a KeePass file of a daemon, "open" with an error is
+        # returned if the file is not decrypted (yet or anymore)
+        if cmd == "db" and self.daemon:
+            if arg_len < 2:
+                return "db", 1, "database id or command is not set", None
+            database = self.databases.get(arg[0])
+            if database is None or database.index is None:
+                return "open", 1, "database '%s' is not open" % arg[0], None
+            return self._dispatch_database(database, *arg[1:])
+
+        if self.database is None:
+            return cmd, 1, "database is not set", None
+        return self._dispatch_database(self.database, cmd, *arg)
+
+    def _dispatch_database(self, database, cmd, *arg):
+        database.last_used = time.monotonic()
+
+        # CMD: password
+        if cmd == "password":
+            return self._password(database, *arg)
+
+        # A request is served from one snapshot of the decrypted file, even
+        # if the file is reloaded in the meantime. The generation is read
+        # first and published after a new snapshot, so a value is never
+        # returned with a newer generation than its snapshot.
+        generation = self.generation
+        index = database.index
+        if index is None:
+            return "password", 1, "", None
+
+        # CMD: fetch
+        # Read data from decrypted KeePass file
+        if cmd == "fetch":
+            status, payload = database.fetch(index, *arg)
+            return "fetch", status, str(payload), generation
+
+        # CMD: mfetch
+        # Read a batch of data from decrypted KeePass file
+        if cmd == "mfetch":
+            return ("mfetch", *database.mfetch(index, *arg), generation)
+
+        # CMD: find
+        # Properties of all entries with a value of a field
+        if cmd == "find":
+            return ("find", *database.find(index, *arg), generation)
+
+        # CMD: snapshot
+        # Fetchable values of the file in a memfd sent with the response, see
+        # ``shared_snapshot``
+        if cmd == "snapshot":
+            if not hasattr(os, "memfd_create") or not hasattr(socket, "send_fds"):
+                return "snapshot", 1, "shared snapshots are not supported", None
+            fd = database.shared_snapshot(index, generation)
+            return "snapshot", 0, "", generation, [fd]
+
+        # CMD: export
+        # All entries of a group and its subgroups, sent in chunks
+        if cmd == "export":
+            return ("export", *database.export(index, *arg), generation)
+
+        return "fetch", 1, "unknown command '%s'" % cmd, None
+
+    def _password(self, database, *arg):
+        try:
+            if len(arg) > 0 and arg[0]:
+                database.unlock(arg[0])
+            elif database.kdbx_key:
+                database.unlock(None)
+            elif database.index is None:
+                return "password", 1, "", None
+        except CredentialsError:
+            print("%s failed to decrypt" % database.kdbx)
+            if not self.daemon:
+                self.shutdown()
+            return "password", 1, "", None
+        return "password", 0, "", self.generation
+
+    def _open(self, *arg):
+        """Add a KeePass file to a daemon and decrypt it
+
+        Arguments are the path of the file, the path of the key file (may be
+        empty), the password (may be empty) and optionally the TTL of the
+        file (a non-negative integer, 0 - never closed). The payload of the
+        response is the id of the database.
+        """
+        if len(arg) < 3 or not all(isinstance(_, str) for _ in arg[:3]):
+            return "open", 1, "kdbx, key and password are not set", None
+        kdbx, kdbx_key, password = arg[:3]
+        ttl = arg[3] if len(arg) > 3 else self.ttl
+        # an invalid TTL would fail the main thread of the daemon later
+        if not isinstance(ttl, int) or isinstance(ttl, bool) or ttl < 0:
+            return "open", 1, "ttl must be a non-negative integer", None
+
+        database = self._add_database(kdbx, kdbx_key or None, ttl)
+        database.ttl = ttl
+        database.last_used = time.monotonic()
+        try:
+            database.unlock(password or None)
+        except CredentialsError:
+            print("%s failed to decrypt" % kdbx)
+            return "open", 1, "wrong dbx password", None
+        except (OSError, ValueError) as e:
+            return "open", 1, str(e), None
+        return "open", 0, database_id(kdbx, kdbx_key or None), self.generation
+
+
+class KeePassDatabase:
+    """A KeePass file served by the socket
+
+    Fetching is read-only, so the decrypted file is shared between workers
+    without locking, only decryption (unlocking and reloading of a changed
+    file) is serialized. A reloaded file is swapped in as a whole, see
+    ``open``.
+    """
+
+    def __init__(
+        self,
+        kdbx,
+        kdbx_key,
+        watch=DEFAULT_WATCH,
+        ttl=0,
+        attachments=None,
+        stats=None,
+        on_open=None,
+        compact=False,
+    ):
+        """
+
+        :param int watch: interval of checks of changes of the file in seconds
+        :param int ttl: seconds without requests until the file is closed,
+            0 - never
+        :param AttachmentStore attachments: where attachments are written to
+        :param ServerStats stats:
+        :param on_open: called after every decryption
+        :param bool compact: keep only fields of entries, see ``KeePassIndex``
+        """
+        self.kdbx = kdbx
+        self.kdbx_key = kdbx_key
+        self.watch = watch
+        self.ttl = ttl
+        self.attachments = attachments if attachments is not None else AttachmentStore()
+        self.stats = stats if stats is not None else ServerStats()
+        self.compact = compact
+        self.index = None
+        self.last_used = time.monotonic()
+        self._on_open = on_open
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._watcher = None
+        self._password = None
+        self._state = None
+        # (index, generation, memfd) of the last shared snapshot
+        self._shared = None
+        self._shared_lock = threading.Lock()
+
+    def unlock(self, password):
+        """Decrypt the file unless it is already decrypted"""
+        with self._lock:
+            if self.index is None:
+                self.open(password)
+
+    def open(self, password=None):
+        """Decrypt the file and serve it instead of the current one
+
+        Called with the lock held.
+        """
+        state = self._file_state()
+        start = time.perf_counter()
+        kp = PyKeePass(self.kdbx, password, self.kdbx_key)
+        index = KeePassIndex(kp, self.compact)
+        del kp
+        self.index = index
+        if self.compact:
+            # the dropped XML tree is freed, but kept in the heap of the process
+            trim_memory()
+        self.stats.decrypted(time.perf_counter() - start)
+        self._password = password
+        self._state = state
+        if self._on_open is not None:
+            self._on_open()
+
+        if self.watch > 0 and self._watcher is None:
+            self._watcher = threading.Thread(
+                target=self._watch,
+                args=(self._stopped,),
+                name="keepass-watch",
+                daemon=True,
+            )
+            self._watcher.start()
+
+    def close(self):
+        """Drop the decrypted file, it is decrypted again by ``unlock``"""
+        with self._lock:
+            self._stopped.set()
+            self._stopped = threading.Event()
+            self._watcher = None
+            self._password = None
+            self.index = None
+        with self._shared_lock:
+            if self._shared is not None:
+                os.close(self._shared[2])
+                self._shared = None
+
+    def changed(self):
+        """Whether the file or the key file has changed since decryption"""
+        return self._file_state() != self._state
+
+    def _file_state(self):
+        state = []
+        for path in (self.kdbx, self.kdbx_key):
+            if path:
+                st = os.stat(path)
+                state.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        return state
+
+    def _watch(self, stopped):
+        """Decrypt the file again when it or the key file is changed
+
+        Requests are served from the previous snapshot until the new one
+        is ready. If the file cannot be decrypted (e.g. it is being written)
+        the previous snapshot is kept until the next change.
+        """
+        while not stopped.wait(self.watch):
+            # kept if the file cannot be read (e.g. it is missing for a moment
+            # while it is saved), the file is checked again on the next round
+            state = self._state
+            try:
+                state = self._file_state()
+                if state == self._state:
+                    continue
+                with self._lock:
+                    if stopped.is_set():
+                        return
+                    self.open(self._password)
+            except Exception as e:
+                self._state = state
+                print("%s failed to reload: %r" % (self.kdbx, e))
+
+    def fetch(self, index, *arg):
+        """Fetch a value of an entry property
+
+        :return: tuple of status code and payload as for ``resp``
+        """
+        arg_len = len(arg)
+        if arg_len == 0:
+            return 1, "path is not set"
+
+        if arg_len == 1:
+            return 1, "property name is not set for '%s'" % arg[0]
+
+        key = path_key(arg[0])
+        entry = index.find(arg[0], key)
+        path = list(key)
+
+        if entry is None:
+            return 1, "path '%s' is not found" % path
+        self.stats.fetched(arg[0])
+
+        prop = arg[1]
+        if prop == "custom_properties":
+            if arg_len == 2:
+                return 1, "no custom_property key for '%s'" % arg[0]
+
+            prop_key = arg[2]
+            custom_properties = entry.custom_properties
+            if prop_key not in custom_properties:
+                return 1, "custom_property '%s' is not found for '%s'" % (
+                    prop_key,
+                    path,
+                )
+            return 0, custom_properties[prop_key]
+
+        if prop == "attachments":
+            if arg_len == 2:
+                return 1, "attachment key is not set for '%s'" % arg[0]
+
+            prop_key = arg[2]
+            attachment = None
+            for _ in entry.attachments:
+                if _.filename == prop_key:
+                    attachment = _
+                    break
+            if attachment is None:
+                return 1, "attachment '%s' is not found for '%s'" % (prop_key, path)
+
+            return 0, self.attachments.path(attachment.data, attachment.filename)
+
+        if not hasattr(entry, prop):
+            return 1, "unknown property '%s' for '%s'" % (prop, path)
+        return index.value(entry, prop)
+
+    def shared_snapshot(self, index, generation):
+        """A memfd with the values of a snapshot, see ``build_snapshot``
+
+        The memfd is made once per snapshot and generation, every client
+        gets a duplicate of it.
+
+        :return: a new file descriptor of the memfd
+        """
+        with self._shared_lock:
+            shared = self._shared
+            if shared is None or shared[0] is not index or shared[1] != generation:
+                if shared is not None:
+                    os.close(shared[2])
+                self._shared = None
+                shared = self._shared = (
+                    index,
+                    generation,
+                    build_snapshot(index, generation),
+                )
+            return os.dup(shared[2])
+
+    def mfetch(self, index, *arg):
+        """Fetch values of several entry properties at once
+
+        Every argument is a ``[path, property[, key]]`` list, the payload of
+        the response is a list of ``[status, value]`` in the same order,
+        a failed query does not fail the others.
+        """
+        if len(arg) == 0:
+            return 1, "queries are not set"
+
+        results = []
+        for query in arg:
+            if not isinstance(query, list) or not all(
+                isinstance(_, str) for _ in query
+            ):
+                results.append((1, "invalid query '%s'" % query))
+                continue
+            status, payload = self.fetch(index, *query)
+            results.append((status, str(payload)))
+        return 0, results
+
+    def find(self, index, *arg):
+        """Find entries by a field and return their properties
+
+        Arguments are the field (one of ``SEARCH_FIELDS``), the value and
+        optionally names of properties (default: ``FIND_PROPERTIES``). The
+        payload is a list of dicts of the path and the properties of the
+        found entries in document order, ``custom_properties`` is a dict
+        and ``attachments`` is a list of file names. An entry with a broken
+        reference has an ``error``, see ``properties``.
+        """
+        if len(arg) < 2 or not all(isinstance(_, str) for _ in arg):
+            return 1, "field and value are not set"
+        field, value = arg[:2]
+        props = arg[2:] or FIND_PROPERTIES
+        try:
+            found = index.search(field, value)
+        except ValueError as e:
+            return 1, str(e)
+
+        results = []
+        for path, entry in found:
+            status, item = self.properties(index, entry, props)
+            if status != 0:
+                return status, item
+            self.stats.fetched(path)
+            results.append({"path": path, **item})
+        return 0, results
+
+    def export(self, index, *arg):
+        """Export all entries of a group and its subgroups
+
+        Arguments are the path of the group ("" - the root group) and
+        optionally a list of names of properties (default:
+        ``EXPORT_PROPERTIES``), the depth of subgroups (None - unlimited,
+        0 - entries of the group only) and whether attachments are exported
+        to files.
+
+        The payload is a list of records in document order: ``[group path]``
+        for a group and ``[group path, title, properties]`` for an entry, a
+        group path is a list of names relative to the exported group. The
+        payload is made and sent in chunks, ``nest`` makes a nested dict of
+        it. An entry with a broken reference has an ``error``, see
+        ``properties``.
+        """
+        if len(arg) == 0 or not isinstance(arg[0], str):
+            return 1, "group path is not set"
+        props = arg[1] if len(arg) > 1 and arg[1] is not None else EXPORT_PROPERTIES
+        depth = arg[2] if len(arg) > 2 else None
+        attachments = bool(arg[3]) if len(arg) > 3 else False
+        if not isinstance(props, list) and props is not EXPORT_PROPERTIES:
+            return 1, "properties must be a list"
+        if not all(isinstance(_, str) for _ in props):
+            return 1, "properties must be a list"
+        if depth is not None and (not isinstance(depth, int) or depth < 0):
+            return 1, "depth must be a non-negative integer"
+
+        key = path_key(arg[0])
+        if key not in index.groups:
+            return 1, "group '%s' is not found" % list(key)
+        return 0, self._export(index, key, props, depth, attachments)
+
+    def _export(self, index, key, props, depth, attachments):
+        # binaries of the XML tree are decoded once, not per attachment
+        binaries = None
+        if attachments and not index.compact:
+            binaries = index.kp.binaries
+        chunk = []
+        stack = [key]
+        while stack:
+            group = stack.pop()
+            relative = list(group[len(key):])
+            chunk.append([relative])
+            positions, subgroups = index.groups[group]
+            for i in positions:
+                path, entry = index.entries[i]
+                if path is None:
+                    continue
+                status, item = self.properties(index, entry, props)
+                if status != 0:
+                    # an unknown property, not an error of the entry
+                    raise ValueError(item)
+                if attachments:
+                    if binaries is None:
+                        files = [(_.filename, _.data) for _ in entry.attachments]
+                    else:
+                        files = [
+                            (filename, binaries[binary_id])
+                            for filename, binary_id in _attachments(entry._element)
+                            if binary_id < len(binaries)
+                        ]
+                    item["attachments"] = {
+                        filename: self.attachments.path(data, filename)
+                        for filename, data in files
+                    }
+                self.stats.fetched(path)
+                chunk.append([relative, path_key(path)[-1], item])
+                if len(chunk) >= EXPORT_CHUNK:
+                    yield chunk
+                    chunk = []
+            if depth is None or len(relative) < depth:
+                # subgroups in document order
+                stack.extend(reversed(subgroups))
+        if chunk:
+            yield chunk
+
+    def properties(self, index, entry, props):
+        """Values of properties of an entry as a dict
+
+        ``custom_properties`` is a dict, ``attachments`` is a list of file
+        names. A property with a broken or circular reference is None and
+        its error is in ``error``, the other properties of the entry and
+        other entries are not affected.
+
+        :return: tuple of status code and the dict or an error of the
+            property names
+        """
+        item = {}
+        errors = []
+        # string fields of an entry of the XML tree are read at once
+        strings = None if index.compact else _strings(entry._element)
+        for prop in props:
+            if prop == "custom_properties":
+                item[prop] = _custom_properties(entry, strings)
+                continue
+            if prop == "attachments":
+                item[prop] = [_.filename for _ in entry.attachments]
+                continue
+            if prop not in PROPERTY_FIELDS and not hasattr(entry, prop):
+                return 1, "unknown property '%s'" % prop
+            status, payload = index.value(entry, prop, strings)
+            if status != 0:
+                errors.append(payload)
+                payload = None
+            if not (payload is None or isinstance(payload, (str, list))):
+                payload = str(payload)
+            item[prop] = payload
+        if errors:
+            item["error"] = "; ".join(errors)
+        return 0, item
+
+
+class KeePassIndex:
+    """Entries of a decrypted KeePass file indexed by path and UUID
+
+    The index is built once after decryption by a walk over the XML tree,
+    so fetching is a dict lookup instead of an XPath query per request.
+    Entries are indexed by title, tag, URL and host name of the URL too,
+    see ``search``, and by group for exports of subtrees.
+    As with ``find_entries_by_path(first=True)`` the first entry in document
+    order wins when several entries have the same path.
+
+    Field references (``{REF:U@I:...}``) are resolved once when the index is
+    built, as ``PyKeePass.deref`` does on every call, so fetching a field
+    with references costs the same as fetching a plain field.
+
+    A compact index (``compact=True``) keeps only the properties of entries
+    which can be fetched, copied to ``CompactEntry`` objects, and drops the
+    decrypted file: the XML tree with history, icons, metadata and deleted
+    objects. Attachments are kept compressed until they are fetched.
+
+    The index is a snapshot of the file, it is never modified after it is
+    built.
+    """
+
+    def __init__(self, kp, compact=False):
+        self.kp = kp
+        self.compact = compact
+        # (path or None, entry) of all entries in document order, the path
+        # is None if a group of the entry has no name
+        self.entries = []
+        # group path -> (positions in entries of its entries, paths of its
+        # subgroups)
+        self.groups = {(): ([], [])}
+        self.paths = {}
+        self.uuids = {}
+        self._uuid_positions = {}
+        # (entry element, field) -> (status code, value or error) for fields
+        # with references and the fields they refer to, entry elements are
+        # replaced by CompactEntry objects in a compact index
+        self.references = {}
+        # (title, URL, tags) of entries while the index is built
+        self._fields = []
+        root = kp.root_group._element
+        self._add_group(kp, root, ())
+        self._resolve_references(root)
+        self._add_search_indexes()
+        del self._fields
+        if compact:
+            self._compact(kp)
+            self.kp = None
+
+    def _add_group(self, kp, group_element, group_path):
+        for element in group_element:
+            if element.tag == "Entry":
+                entry = Entry(element=element, kp=kp)
+                entry_uuid = entry.uuid.hex
+                if entry_uuid not in self.uuids:
+                    self.uuids[entry_uuid] = entry
+                    self._uuid_positions[entry_uuid] = len(self.entries)
+                # string fields are read by one walk over the element
+                # instead of an XPath query per field
+                strings = _strings(element)
+                title = strings.get("Title")
+                path = None
+                if group_path is not None and title is not None:
+                    key = group_path + (title,)
+                    self.paths.setdefault(key, entry)
+                    path = "/".join(_.replace("/", "\\/") for _ in key)
+                if group_path is not None:
+                    self.groups[group_path][0].append(len(self.entries))
+                self.entries.append((path, entry))
+                self._fields.append((title, strings.get("URL"), _text(element, "Tags")))
+            elif element.tag == "Group":
+                # a group without a name is not reachable by a path
+                name = element.findtext("Name")
+                if group_path is None or name is None:
+                    self._add_group(kp, element, None)
+                else:
+                    subgroup = group_path + (name,)
+                    if subgroup not in self.groups:
+                        # groups with the same path are merged
+                        self.groups[subgroup] = ([], [])
+                        self.groups[group_path][1].append(subgroup)
+                    self._add_group(kp, element, subgroup)
+
+    def _resolve_references(self, root):
+        strings = root.xpath('.//Entry[parent::Group]/String[contains(Value, "{REF:")]')
+        if not strings:
+            return
+        # field -> {value -> first entry element with the value}
+        self._search = {}
+        self._entries = root.xpath(".//Entry[parent::Group]")
+        for string in strings:
+            field = string.findtext("Key")
+            if field in PROPERTY_FIELDS.values():
+                try:
+                    self._resolve(string.getparent(), field, ())
+                except BrokenReference:
+                    pass
+        del self._search
+        del self._entries
+
+    def _resolve(self, element, field, chain):
+        """Value of a field of an entry with references replaced
+
+        A result (or an error) is stored in ``references``.
+
+        :param tuple chain: fields being resolved, to detect cycles
+        :raise BrokenReference: a reference is not found or is circular
+        """
+        key = (element, field)
+        result = self.references.get(key)
+        if result is not None:
+            if result[0] != 0:
+                raise BrokenReference(result[1])
+            return result[1]
+        if key in chain:
+            raise BrokenReference(
+                "circular reference of %s of entry '%s'"
+                % (field, _field(element, "Title"))
+            )
+
+        def replace(match):
+            wanted, search_in, search_value = match.groups()
+            target = self._search_entry(REFERENCE_FIELDS[search_in], search_value)
+            if target is None:
+                raise BrokenReference(
+                    "reference '%s' in %s is not found" % (match.group(0), field)
+                )
+            return self._resolve(target, REFERENCE_FIELDS[wanted], chain + (key,))
+
+        value = _field(element, field)
+        try:
+            if value and "{REF:" in value:
+                value = REFERENCE.sub(replace, value)
+        except RecursionError:
+            self.references[key] = (1, "too deep references in %s" % field)
+            raise BrokenReference(self.references[key][1])
+        except BrokenReference as e:
+            self.references[key] = (1, str(e))
+            raise
+        self.references[key] = (0, value)
+        return value
+
+    def _add_search_indexes(self):
+        """Index entries by title, tag, URL and host name
+
+        Tables map a value to positions in ``entries``, so they are valid
+        for a compact index too. References in titles and URLs are resolved.
+        """
+        self.titles = {}
+        self.urls = {}
+        self.hosts = {}
+        self.tags = {}
+        for i, (title, url, tags) in enumerate(self._fields):
+            element = self.entries[i][1]._element
+            if title and "{REF:" in title:
+                title = self._resolved(element, "Title", title)
+            if title:
+                self.titles.setdefault(title, []).append(i)
+
+            if url and "{REF:" in url:
+                url = self._resolved(element, "URL", url)
+            if url:
+                self.urls.setdefault(url, []).append(i)
+                match = URL_HOST.match(url)
+                if match and match.group(1):
+                    host = match.group(1).strip("[]").lower()
+                    self.hosts.setdefault(host, []).append(i)
+
+            if tags:
+                for tag in set(TAG_SEPARATOR.split(tags)):
+                    tag = tag.strip()
+                    if tag:
+                        self.tags.setdefault(tag, []).append(i)
+
+    def _resolved(self, element, field, value):
+        result = self.references.get((element, field))
+        if result is None:
+            return value
+        return result[1] if result[0] == 0 else None
+
+    def _compact(self, kp):
+        binaries = [CompactBinary(_) for _ in kp.binaries]
+        # entry element -> CompactEntry, every entry is copied once
+        entries = {}
+        for i, (path, entry) in enumerate(self.entries):
+            compact_entry = entries.get(entry._element)
+            if compact_entry is None:
+                compact_entry = entries[entry._element] = CompactEntry(
+                    entry, binaries
+                )
+            self.entries[i] = (path, compact_entry)
+        for table in (self.uuids, self.paths):
+            for key, entry in table.items():
+                table[key] = entries[entry._element]
+        self.references = {
+            (entries[element], field): result
+            for (element, field), result in self.references.items()
+            if element in entries
+        }
+
+    def _search_entry(self, field, value):
+        if field == "UUID":
+            try:
+                entry = self.uuids.get(uuid.UUID(value).hex)
+            except ValueError:
+                return None
+            return entry._element if entry is not None else None
+        if field not in self._search:
+            values = self._search[field] = {}
+            for element in self._entries:
+                values.setdefault(_field(element, field), element)
+        return self._search[field].get(value)
+
+    def value(self, entry, prop, strings=None):
+        """Value of an entry property with resolved references
+
+        :param dict strings: string fields of the entry if they are read
+            already, see ``_strings``
+        :return: tuple of status code and payload as for ``resp``
+        """
+        element = entry if self.compact else entry._element
+        field = PROPERTY_FIELDS.get(prop)
+        result = self.references.get((element, field))
+        if result is not None:
+            return result
+        if strings is not None:
+            if field is not None:
+                return 0, strings.get(field)
+            if prop == "otp":
+                # a string field without references, as pykeepass reads it
+                return 0, strings.get("otp")
+        return 0, getattr(entry, prop)
+
+    def search(self, field, value):
+        """Find all entries with a value of a field
+
+        :param str field: ``uuid``, ``title``, ``tag``, ``url`` (the URL or
+            its host name) or ``path`` (a regular expression searched for in
+            paths)
+        :return: list of (path, entry) in document order
+        :raise ValueError: an unknown field or an invalid regular expression
+        """
+        if field == "uuid":
+            try:
+                position = self._uuid_positions.get(uuid.UUID(value).hex)
+            except ValueError:
+                position = None
+            positions = [] if position is None else [position]
+        elif field == "title":
+            positions = self.titles.get(value, [])
+        elif field == "tag":
+            positions = self.tags.get(value, [])
+        elif field == "url":
+            positions = sorted(
+                set(self.urls.get(value, [])) | set(self.hosts.get(value.lower(), []))
+            )
+        elif field == "path":
+            try:
+                pattern = re.compile(value)
+            except re.error as e:
+                raise ValueError("invalid regular expression '%s': %s" % (value, e))
+            # a pattern cannot be indexed, paths are matched one by one
+            return [
+                _ for _ in self.entries if _[0] is not None and pattern.search(_[0])
+            ]
+        else:
+            raise ValueError(
+                "unknown field '%s', expected one of %s"
+                % (field, ", ".join(SEARCH_FIELDS))
+            )
+        return [self.entries[_] for _ in positions]
+
+    def find(self, path, key=None):
+        """Find an entry by a path or UUID
+
+        :param str path: "group/subgroup/title" or UUID of an entry
+        :param tuple key: the path already split by ``path_key``
+        """
+        if key is None:
+            key = path_key(path)
+        entry = self.paths.get(key)
+        if entry is None:
+            try:
+                entry = self.uuids.get(uuid.UUID(path).hex)
+            except ValueError:
+                pass
+        return entry
+
+
+class BrokenReference(ValueError):
+    pass
+
+
+class CompactEntry:
+    """Properties of an entry copied from the XML tree
+
+    Has the attributes of ``pykeepass.entry.Entry`` which the socket serves:
+    ``COMPACT_PROPERTIES``, ``custom_properties`` and ``attachments``.
+    """
+
+    __slots__ = COMPACT_PROPERTIES + ("custom_properties", "attachments")
+
+    def __init__(self, entry, binaries):
+        """
+
+        :param pykeepass.entry.Entry entry:
+        :param list binaries: CompactBinary by id of binaries of the file
+        """
+        element = entry._element
+        strings = _strings(element)
+        for prop, field in PROPERTY_FIELDS.items():
+            setattr(self, prop, strings.get(field))
+        self.otp = strings.get("otp")
+        self.uuid = uuid.UUID(bytes=base64.b64decode(_text(element, "UUID")))
+        tags = _text(element, "Tags")
+        self.tags = tags.split(";") if tags else tags
+        self.custom_properties = {
+            k: v for k, v in strings.items() if k not in reserved_keys
+        }
+
+        self.attachments = tuple(
+            CompactAttachment(filename, binaries[binary_id])
+            for filename, binary_id in _attachments(element)
+            if binary_id < len(binaries)
+        )
+
+
+class CompactAttachment:
+    __slots__ = ("filename", "binary")
+
+    def __init__(self, filename, binary):
+        self.filename = filename
+        self.binary = binary
+
+    @property
+    def data(self):
+        return self.binary.data
+
+
+class CompactBinary:
+    """Content of an attachment, compressed if it gets smaller"""
+
+    __slots__ = ("_data", "_compressed")
+
+    def __init__(self, data):
+        compressed = zlib.compress(data, 1)
+        self._compressed = len(compressed) < len(data)
+        self._data = compressed if self._compressed else bytes(data)
+
+    @property
+    def data(self):
+        return zlib.decompress(self._data) if self._compressed else self._data
+
+
+def _text(element, tag):
+    """Text of a child element as pykeepass reads it, None if it is empty"""
+    child = element.find(tag)
+    return child.text if child is not None else None
+
+
+def _custom_properties(entry, strings=None):
+    """Custom properties of an entry, from its string fields if they are read"""
+    if strings is None:
+        return dict(entry.custom_properties)
+    return {k: v for k, v in strings.items() if k not in reserved_keys}
+
+
+def _strings(element):
+    """String fields of an entry element, the first field wins as in pykeepass"""
+    strings = {}
+    for string in element.iterfind("String"):
+        key = value = None
+        for child in string:
+            if child.tag == "Key":
+                key = child.text
+            elif child.tag == "Value":
+                value = child.text
+        strings.setdefault(key, value)
+    return strings
+
+
+def _attachments(element):
+    """File names and binary ids of attachments of an entry element"""
+    for binary in element.iterfind("Binary"):
+        value = binary.find("Value")
+        try:
+            binary_id = int(value.get("Ref"))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if binary_id >= 0:
+            yield _text(binary, "Key"), binary_id
+
+
+def _field(element, field):
+    """Raw value of a string field of an entry element"""
+    if field == "UUID":
+        text = element.findtext("UUID")
+        return uuid.UUID(bytes=base64.b64decode(text)).hex.upper() if text else None
+    for string in element.iterfind("String"):
+        if string.findtext("Key") == field:
+            return string.findtext("Value")
+    return None
+
+
+class AttachmentStore:
+    """Attachments exported to files, stored once per content
+
+    A file is named by the SHA-256 of its content, so an attachment fetched
+    for many hosts is written once and the same path is returned every time.
+    Files are kept in a private directory which is created on first use and
+    removed with ``cleanup``. When the total size exceeds ``maxsize`` least
+    recently fetched files are removed, the last fetched file is always kept.
+    """
+
+    def __init__(self, maxsize=DEFAULT_ATTACHMENT_CACHE):
+        self.maxsize = maxsize
+        self.directory = None
+        self.size = 0
+        self.written = 0
+        self.reused = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def path(self, data, filename):
+        name = "%s.%s" % (
+            hashlib.sha256(data).hexdigest(),
+            os.path.basename(filename),
+        )
+        with self._lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="ansible-keepass-")
+                # mkdtemp mode is masked by the umask of the socket (0177)
+                os.chmod(self.directory, 0o700)
+            path = os.path.join(self.directory, name)
+
+            if name in self._files:
+                self._files.move_to_end(name)
+                self.reused += 1
+                return path
+
+            # written under a temporary name, a path is never seen with
+            # partial content
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._files[name] = len(data)
+            self.size += len(data)
+            self.written += 1
+
+            while self.size > self.maxsize and len(self._files) > 1:
+                evicted, size = self._files.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except FileNotFoundError:
+                    pass
+            return path
+
+    def cleanup(self):
+        with self._lock:
+            if self.directory is not None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+            self._files.clear()
+            self.size = 0
+
+
+class ServerStats:
+    """Counters and latency histograms of requests to the socket
+
+    Updated by worker threads, read by the ``stats`` command and written
+    to a Prometheus textfile.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = {}
+        self.errors = {}
+        # command -> counts per bucket of LATENCY_BUCKETS and +Inf, sum
+        self.latency = {}
+        self.paths = Counter()
+        self.decryptions = 0
+        self.decrypt_seconds = None
+        self._lock = threading.Lock()
+
+    def record(self, cmd, status_code, seconds):
+        if cmd not in COMMANDS:
+            cmd = "unknown"
+        with self._lock:
+            self.requests[cmd] = self.requests.get(cmd, 0) + 1
+            if status_code != 0:
+                self.errors[cmd] = self.errors.get(cmd, 0) + 1
+            if cmd not in self.latency:
+                self.latency[cmd] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram = self.latency[cmd]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    def fetched(self, path):
+        with self._lock:
+            self.paths[path] += 1
+
+    def decrypted(self, seconds):
+        with self._lock:
+            self.decryptions += 1
+            self.decrypt_seconds = seconds
+
+    def snapshot(self):
+        with self._lock:
+            latency = {}
+            for cmd, (counts, total) in self.latency.items():
+                cumulative = 0
+                buckets = []
+                for le, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                    cumulative += count
+                    buckets.append([le, cumulative])
+                latency[cmd] = {"buckets": buckets, "count": cumulative, "sum": total}
+            return {
+                "uptime": time.time() - self.started,
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "latency": latency,
+                "decryptions": self.decryptions,
+                "decrypt_seconds": self.decrypt_seconds,
+                "hot_paths": self.paths.most_common(HOT_PATHS),
+            }
+
+
+def trim_memory():
+    """Give freed heap memory back to the system (glibc only)"""
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (AttributeError, OSError):
+        pass
+
+
+def rss():
+    """Resident memory of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # peak, in KiB on Linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def stats_payload(stats, databases, generation, attachments):
+    """Payload of the ``stats`` command
+
+    :param ServerStats stats:
+    :param dict databases: database id -> ``KeePassDatabase``
+    :param int generation: generation of the decrypted files
+    :param AttachmentStore attachments:
+    """
+    payload = stats.snapshot()
+    now = time.monotonic()
+    items = []
+    for db_id, database in list(databases.items()):
+        index = database.index
+        items.append(
+            {
+                "id": db_id,
+                "kdbx": database.kdbx,
+                "open": index is not None,
+                "entries": len(index.uuids) if index else 0,
+                "idle": now - database.last_used,
+            }
+        )
+    payload["generation"] = generation
+    payload["databases"] = items
+    payload["entries"] = sum(_["entries"] for _ in items)
+    payload["rss_bytes"] = rss()
+    payload["attachments"] = {
+        "written": attachments.written,
+        "reused": attachments.reused,
+        "files": len(attachments),
+        "bytes": attachments.size,
+    }
+    return payload
+
+
+def prometheus(stats):
+    """Format a payload of the ``stats`` command as Prometheus text"""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append("# HELP keepass_%s %s" % (name, help_text))
+        lines.append("# TYPE keepass_%s %s" % (name, metric_type))
+        for suffix, labels, value in samples:
+            label_text = ",".join('%s="%s"' % _ for _ in labels)
+            lines.append(
+                "keepass_%s%s%s %s"
+                % (name, suffix, "{%s}" % label_text if label_text else "", value)
+            )
+
+    metric(
+        "requests_total",
+        "counter",
+        "Requests by command",
+        [("", [("command", k)], v) for k, v in sorted(stats["requests"].items())],
+    )
+    metric(
+        "errors_total",
+        "counter",
+        "Failed requests by command",
+        [("", [("command", k)], v) for k, v in sorted(stats["errors"].items())],
+    )
+    samples = []
+    for cmd, histogram in sorted(stats["latency"].items()):
+        for le, count in histogram["buckets"]:
+            samples.append(("_bucket", [("command", cmd), ("le", le)], count))
+        samples.append(("_sum", [("command", cmd)], histogram["sum"]))
+        samples.append(("_count", [("command", cmd)], histogram["count"]))
+    metric("request_duration_seconds", "histogram", "Request latency", samples)
+    metric(
+        "uptime_seconds", "gauge", "Time since start", [("", [], stats["uptime"])]
+    )
+    metric(
+        "decryptions_total",
+        "counter",
+        "Decryptions of the KeePass file",
+        [("", [], stats["decryptions"])],
+    )
+    if stats["decrypt_seconds"] is not None:
+        metric(
+            "decrypt_duration_seconds",
+            "gauge",
+            "Duration of the last decryption",
+            [("", [], stats["decrypt_seconds"])],
+        )
+    metric("entries", "gauge", "Entries in the index", [("", [], stats["entries"])])
+    metric(
+        "resident_memory_bytes",
+        "gauge",
+        "Resident memory of the socket",
+        [("", [], stats["rss_bytes"])],
+    )
+    metric(
+        "attachments_written_total",
+        "counter",
+        "Attachments written to files",
+        [("", [], stats["attachments"]["written"])],
+    )
+    metric(
+        "attachments_reused_total",
+        "counter",
+        "Attachments fetched from already written files",
+        [("", [], stats["attachments"]["reused"])],
+    )
+    metric(
+        "attachment_files_bytes",
+        "gauge",
+        "Size of written attachment files",
+        [("", [], stats["attachments"]["bytes"])],
+    )
+    return "\n".join(lines) + "\n"
+
+
+def path_key(path):
+    """Split an entry path into a tuple of unescaped group names and title"""
+    return tuple(_.replace("\\/", "/") for _ in PATH_SEPARATOR.split(path) if _ != "")
+
+
+def nest(records):
+    """Nested dict of a group from records of the export command
+
+    A group is ``{"entries": {title: properties}, "groups": {name: group}}``,
+    the first of entries with the same title wins.
+    """
+    root = {"entries": {}, "groups": {}}
+    for record in records:
+        group = root
+        for name in record[0]:
+            group = group["groups"].setdefault(name, {"entries": {}, "groups": {}})
+        if len(record) > 2:
+            group["entries"].setdefault(record[1], record[2])
+    return root
+
+
+def snapshot_key(path, *prop):
+    """Key of a value in a shared snapshot
+
+    :param tuple path: entry path split by ``path_key``
+    :param prop: property name and the key of a custom property
+    """
+    return "\x1f".join(path + prop)
+
+
+def build_snapshot(index, generation):
+    """Write values of an index to a sealed memfd
+
+    Values are the ones ``fetch`` returns for ``COMPACT_PROPERTIES`` and
+    custom properties of entries with a path. The
+    index maps ``snapshot_key`` to the offset and length of a value, lists
+    keys of entry paths and maps UUIDs of entries to keys of their paths.
+    Other queries, failed ones and attachments are left to the socket. The
+    memfd is never in a file system, it is passed to clients over the socket
+    and mapped read-only.
+
+    :return: file descriptor of the memfd
+    """
+    data = bytearray(SNAPSHOT_HEADER.size)
+    values = {}
+
+    def add(key, value):
+        encoded = str(value).encode()
+        values[key] = (len(data), len(encoded))
+        data.extend(encoded)
+
+    # id of an entry -> its path, entries are not hashable
+    paths = {}
+    for path, entry in index.paths.items():
+        paths[id(entry)] = path
+        strings = None if index.compact else _strings(entry._element)
+        for prop in COMPACT_PROPERTIES:
+            status, value = index.value(entry, prop, strings)
+            if status == 0:
+                add(snapshot_key(path, prop), value)
+        for name, value in _custom_properties(entry, strings).items():
+            add(snapshot_key(path, "custom_properties", name), value)
+    uuids = {
+        entry_uuid: snapshot_key(paths[id(entry)])
+        for entry_uuid, entry in index.uuids.items()
+        if id(entry) in paths
+    }
+
+    body = json.dumps(
+        {
+            "values": values,
+            "paths": [snapshot_key(_) for _ in index.paths],
+            "uuids": uuids,
+        }
+    ).encode()
+    offset = len(data)
+    data.extend(body)
+    SNAPSHOT_HEADER.pack_into(
+        data, 0, SNAPSHOT_MAGIC, generation or 0, offset, len(body)
+    )
+
+    fd = os.memfd_create("keepass-snapshot", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        fcntl.fcntl(
+            fd,
+            fcntl.F_ADD_SEALS,
+            fcntl.F_SEAL_SEAL
+            | fcntl.F_SEAL_SHRINK
+            | fcntl.F_SEAL_GROW
+            | fcntl.F_SEAL_WRITE,
+        )
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+class SharedSnapshot:
+    """Values of a KeePass file mapped from a memfd of the socket
+
+    Fetching a value is a dict lookup and a slice of the mapping, without
+    requests to the socket. A snapshot is never changed, a reloaded file
+    is sent as a new memfd with a new generation.
+    """
+
+    def __init__(self, fd):
+        """
+
+        :param int fd: the memfd, it is closed after mapping
+        """
+        try:
+            self.map = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, self.generation, offset, length = SNAPSHOT_HEADER.unpack_from(
+            self.map
+        )
+        if magic != SNAPSHOT_MAGIC:
+            self.map.close()
+            raise ProtocolError("not a keepass snapshot")
+        index = json.loads(self.map[offset:offset + length])
+        self.values = index["values"]
+        self.paths = set(index["paths"])
+        self.uuids = index["uuids"]
+
+    def get(self, query, default=None):
+        """Value of a ``[path, property[, key]]`` query as ``fetch`` returns it
+
+        :return: ``default`` if the value is not in the snapshot
+        """
+        path = path_key(query[0])
+        key = snapshot_key(path)
+        if key not in self.paths:
+            # an entry is found by its UUID if there is no entry at the path
+            try:
+                key = self.uuids.get(uuid.UUID(query[0]).hex)
+            except ValueError:
+                key = None
+            if key is None:
+                return default
+        value = self.values.get("\x1f".join((key,) + tuple(query[1:])))
+        if value is None:
+            return default
+        offset, length = value
+        return self.map[offset:offset + length].decode()
+
+    def close(self):
+        self.map.close()
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class FrameReader:
+    """Reads length-prefixed frames of the keepass socket protocol
+
+    A frame is ``FRAME_HEADER`` (magic, protocol version, body length)
+    followed by a JSON body, so any payload, including multi-line values,
+    is transferred as is. Data is received by large reads into one buffer,
+    a frame is decoded when the whole body has arrived.
+    """
+
+    def __init__(self, sock, bufsize=65536, receive_fds=False):
+        """
+
+        :param bool receive_fds: keep file descriptors sent with frames in
+            ``fds``
+        """
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = bytearray()
+        self.receive_fds = receive_fds
+        self.fds = []
+        # time spent decoding messages
+        self.decode_seconds = 0.0
+
+    def _fill(self, size):
+        while len(self.buf) < size:
+            if self.receive_fds:
+                chunk, fds, _, _ = socket.recv_fds(
+                    self.sock, max(self.bufsize, size - len(self.buf)), 4
+                )
+                self.fds.extend(fds)
+            else:
+                chunk = self.sock.recv(max(self.bufsize, size - len(self.buf)))
+            if not chunk:
+                return False
+            self.buf += chunk
+        return True
+
+    def has_frame(self):
+        """Whether a whole frame is received and can be read without blocking"""
+        if len(self.buf) < FRAME_HEADER.size:
+            return False
+        length = FRAME_HEADER.unpack_from(self.buf)[2]
+        return len(self.buf) >= FRAME_HEADER.size + length
+
+    def read(self):
+        """Read the next message
+
+        :return: decoded message or None if the connection is closed
+        """
+        if not self._fill(FRAME_HEADER.size):
+            if self.buf:
+                raise ProtocolError("connection closed in the middle of a frame")
+            return None
+
+        magic, version, length = FRAME_HEADER.unpack_from(self.buf)
+        if magic != FRAME_MAGIC:
+            raise ProtocolError("not a keepass socket message")
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError("unsupported protocol version %s" % version)
+
+        end = FRAME_HEADER.size + length
+        if not self._fill(end):
+            raise ProtocolError("connection closed in the middle of a frame")
+        body = self.buf[FRAME_HEADER.size:end]
+        del self.buf[:end]
+        start = time.perf_counter()
+        message = json.loads(body)
+        self.decode_seconds += time.perf_counter() - start
+        return message
+
+
+def frame(message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, len(body)) + body
+
+
+def rq(cmd, *arg):
+    """Request to keepass socket
+
+    :param str cmd: Command name
+    :param arg: Arguments
+    """
+    return frame((cmd, *arg))
+
+
+def resp(cmd, status_code, payload="", generation=None):
+    """Response from keepass socket
+
+    :param str cmd: Command name
+    :param int status_code: == 0 - no error; 1 - an error
+    :param payload: A data from keepass or error description
+    :param int generation: Generation of the decrypted KeePass file
+    """
+    return frame((cmd, status_code, payload, generation))
+
+
+def socket_path(dbx_path=None):
+    # UNIX socket path for a dbx (supported multiple dbx), or for the daemon
+    # serving all dbx of the user if dbx_path is None
+    if "ANSIBLE_KEEPASS_SOCKET" in os.environ:
+        return os.environ.get('ANSIBLE_KEEPASS_SOCKET')
+    # else:
+    tempdir = tempfile.gettempdir()
+    if not os.access(tempdir, os.W_OK):
+        raise PermissionError("no write permissions to '%s'" % tempdir)
+
+    if dbx_path is None:
+        dbx_path = ":daemon"
+    suffix = hashlib.sha1(("%s%s" % (getpass.getuser(), dbx_path)).encode()).hexdigest()
+    return "%s/ansible-keepass-%s.sock" % (tempdir, suffix[:8])
+
+
+def database_id(kdbx, kdbx_key=None):
+    """Id of a KeePass file in a daemon, the same file with another key file
+    is another database"""
+    return hashlib.sha1(("%s\0%s" % (kdbx, kdbx_key or "")).encode()).hexdigest()[:16]
+
+
+def notify_ready(ready_fd, status, message=""):
+    if ready_fd is None:
+        return
+    try:
+        os.write(ready_fd, ("%s %s" % (status, message)).encode())
+        os.close(ready_fd)
+    except OSError:
+        pass
+
+
+def lock(kdbx_sock_path):
+    fd = os.open(kdbx_sock_path + ".lock", os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+
+    try:
+        # The LOCK_EX means that only one process can hold the lock
+        # The LOCK_NB means that the fcntl.flock() is not blocking
+        # https://docs.python.org/3/library/fcntl.html#fcntl.flock
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return None
+
+    return fd
+
+
+def spawn_lock(kdbx_sock_path):
+    """Wait for and take the lock of starting of the socket
+
+    Lookups of many Ansible workers find the socket is not running at
+    once, the one holding the lock starts it, the others wait and use it.
+    The file is not removed, a removed file could be locked twice.
+
+    :return: fd of the lock file, closing it releases the lock
+    """
+    fd = os.open(kdbx_sock_path + ".spawn", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def spawn_failed(fd, key, message):
+    """Record a failed start of the socket in the spawn lock file
+
+    :param int fd: fd of ``spawn_lock``
+    :param str key: what the start failed for, see ``spawn_failure``
+    """
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, ("%d\n%s\n%s" % (time.time_ns(), key, message)).encode(), 0)
+
+
+def spawn_failure(fd, key, since):
+    """Error of a start of the socket for the key which failed after ``since``
+
+    Processes which would start the socket the same way fail with its error
+    instead of starting it one after another.
+
+    :param int fd: fd of ``spawn_lock``
+    :param str key: e.g. the KeePass file and the process starting workers
+    :param int since: ``time.time_ns`` of the oldest failure to report
+    :return: the error or None
+    """
+    record = os.pread(fd, 65536, 0).decode(errors="replace").split("\n", 2)
+    try:
+        if len(record) == 3 and record[1] == key and int(record[0]) >= since:
+            return record[2]
+    except ValueError:
+        pass
+    return None
+
+
+def locked(kdbx_sock_path):
+    """Whether a socket holds the lock file of the socket path"""
+    try:
+        fd = os.open(kdbx_sock_path + ".lock", os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("kdbx", type=str)
+    arg_parser.add_argument("kdbx_sock", type=str, nargs="?", default=None)
+    arg_parser.add_argument("ttl", type=int, nargs="?", default=0)
+    arg_parser.add_argument("--key", type=str, nargs="?", default=None)
+    arg_parser.add_argument("--ask-pass", action="store_true")
+    arg_parser.add_argument("--password-stdin", action="store_true")
+    arg_parser.add_argument("--ready-fd", type=int, default=None)
+    arg_parser.add_argument("--workers", type=int, default=None)
+    arg_parser.add_argument("--backlog", type=int, default=None)
+    arg_parser.add_argument("--watch", type=float, default=None)
+    arg_parser.add_argument("--attachment-cache", type=int, default=None)
+    arg_parser.add_argument("--metrics-file", type=str, default=None)
+    arg_parser.add_argument("--metrics-interval", type=float, default=None)
+    arg_parser.add_argument("--daemon", action="store_true")
+    arg_parser.add_argument("--compact", action="store_true")
+    arg_parser.add_argument("--parent-pid", type=int, default=None)
+    arg_parser.add_argument("--max-lifetime", type=float, default=None)
+    args = arg_parser.parse_args()
+
+    arg_kdbx = os.path.realpath(os.path.expanduser(os.path.expandvars(args.kdbx)))
+    if args.key:
+        arg_key = os.path.realpath(os.path.expanduser(os.path.expandvars(args.key)))
+    else:
+        arg_key = None
+
+    if args.kdbx_sock:
+        arg_kdbx_sock = args.kdbx_sock
+    else:
+        arg_kdbx_sock = socket_path(None if args.daemon else arg_kdbx)
+
+    password = None
+    if args.password_stdin:
+        password = sys.stdin.read()
+    elif args.ask_pass:
+        password = getpass.getpass("Password: ")
+        if isinstance(password, bytes):
+            password = password.decode(sys.stdin.encoding)
+    elif "ANSIBLE_KEEPASS_PSW" in os.environ:
+        password = os.environ.get('ANSIBLE_KEEPASS_PSW')
+
+    arg_ttl = args.ttl
+    if arg_ttl is None and "ANSIBLE_KEEPASS_TTL" in os.environ:
+        arg_ttl = os.environ.get('ANSIBLE_KEEPASS_TTL')
+
+    os.umask(0o177)
+    lock_fd = lock(arg_kdbx_sock)
+    if lock_fd is not None:
+        serve(
+            arg_kdbx,
+            arg_key,
+            arg_kdbx_sock,
+            arg_ttl,
+            password,
+            args.workers,
+            args.backlog,
+            args.ready_fd,
+            lock_fd,
+            args.watch,
+            args.attachment_cache,
+            args.metrics_file,
+            args.metrics_interval,
+            args.daemon,
+            args.compact,
+            args.parent_pid,
+            args.max_lifetime,
+        )
+
+
+if __name__ == "__main__":
+    main()
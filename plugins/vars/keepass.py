@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+__metaclass__ = type
+
+import os
+import re
+
+from ansible.errors import AnsibleParserError
+from ansible.inventory.group import Group
+from ansible.inventory.host import Host
+from ansible.plugins.vars import BaseVarsPlugin
+from ansible.utils.display import Display
+from ansible.utils.unsafe_proxy import wrap_var
+
+from ansible_collections.viczem.keepass.plugins.plugin_utils import keepass_socket
+
+DOCUMENTATION = """
+    name: keepass
+    short_description: Host and group variables from a KeePass file
+    description:
+        - Entries of a KeePass file become variables of inventory hosts and
+          groups, named by the titles of the entries (characters which are
+          not allowed in variable names are replaced with C(_)) and valued
+          with a dict of their properties
+        - Entries of the KeePass group C(<group>/hosts/<host>) belong to the
+          host C(<host>), entries of C(<group>/groups/<name>) to the
+          inventory group C(<name>)
+        - Entries tagged C(host:<host>) or C(group:<name>) belong to the host
+          or the inventory group too
+        - The file is decrypted and entries are mapped to hosts and groups
+          once, values are read when variables of a host or a group are
+          loaded for the first time, secrets of other hosts are never read
+        - Values are never templated
+        - A property with a broken or circular reference is C(null) and a
+          warning is shown, other properties and entries are not affected
+    requirements:
+        - enable in configuration with
+          C(vars_plugins_enabled = host_group_vars,viczem.keepass.keepass)
+    options:
+      dbx:
+        description: Path of the KeePass file, the plugin is disabled if not set
+        type: path
+        env:
+          - name: ANSIBLE_KEEPASS_VARS_DBX
+        ini:
+          - section: vars_keepass
+            key: dbx
+      password:
+        description: Password of the KeePass file
+        env:
+          - name: ANSIBLE_KEEPASS_PSW
+        ini:
+          - section: vars_keepass
+            key: password
+      key:
+        description: Path of the key file of the KeePass file
+        type: path
+        env:
+          - name: ANSIBLE_KEEPASS_KEY_FILE
+        ini:
+          - section: vars_keepass
+            key: key
+      group:
+        description:
+          - Path of the KeePass group with C(hosts) and C(groups) subgroups,
+            entries are mapped by tags only if not set
+        env:
+          - name: ANSIBLE_KEEPASS_VARS_GROUP
+        ini:
+          - section: vars_keepass
+            key: group
+      tags:
+        description: Map entries tagged C(host:<host>) and C(group:<name>)
+        type: bool
+        default: true
+        env:
+          - name: ANSIBLE_KEEPASS_VARS_TAGS
+        ini:
+          - section: vars_keepass
+            key: tags
+      properties:
+        description: Properties of an entry in its variable
+        type: list
+        elements: str
+        default: [username, password, url, notes, custom_properties]
+        env:
+          - name: ANSIBLE_KEEPASS_VARS_PROPERTIES
+        ini:
+          - section: vars_keepass
+            key: properties
+      prefix:
+        description: Prefix of the names of variables
+        default: ""
+        env:
+          - name: ANSIBLE_KEEPASS_VARS_PREFIX
+        ini:
+          - section: vars_keepass
+            key: prefix
+      compact:
+        description: Keep only the fields of entries in memory, see C(keepass_compact)
+        type: bool
+        default: false
+        env:
+          - name: ANSIBLE_KEEPASS_COMPACT
+        ini:
+          - section: vars_keepass
+            key: compact
+      stage:
+        ini:
+          - key: stage
+            section: vars_keepass
+        env:
+          - name: ANSIBLE_VARS_PLUGIN_STAGE
+    extends_documentation_fragment:
+      - vars_plugin_staging
+"""
+
+# Tags of entries of hosts and groups
+TAG_KINDS = {"host:": "host", "group:": "group"}
+# Subgroups of the group of the plugin with entries of hosts and groups
+GROUP_KINDS = {"hosts": "host", "groups": "group"}
+INVALID_NAME_CHARS = re.compile(r"\W")
+
+display = Display()
+
+# (path, key file, options) -> KeePassVars, shared by all calls of the process
+_FILES = {}
+
+
+class VarsModule(BaseVarsPlugin):
+    def get_vars(self, loader, path, entities, cache=True):
+        super(VarsModule, self).get_vars(loader, path, entities)
+
+        dbx = self.get_option("dbx")
+        if not dbx:
+            return {}
+        dbx = os.path.realpath(os.path.expanduser(dbx))
+        kdbx_key = self.get_option("key")
+        if kdbx_key:
+            kdbx_key = os.path.realpath(os.path.expanduser(kdbx_key))
+        options = (
+            self.get_option("group"),
+            self.get_option("tags"),
+            tuple(self.get_option("properties")),
+            self.get_option("prefix"),
+            self.get_option("compact"),
+        )
+
+        key = (dbx, kdbx_key or None, options)
+        keepass_vars = _FILES.get(key)
+        if keepass_vars is None or keepass_vars.database.changed():
+            keepass_vars = _FILES[key] = KeePassVars(
+                dbx, kdbx_key or None, self.get_option("password"), *options
+            )
+
+        data = {}
+        for entity in entities:
+            if isinstance(entity, Host):
+                data.update(keepass_vars.get("host", entity.name))
+            elif isinstance(entity, Group):
+                data.update(keepass_vars.get("group", entity.name))
+            else:
+                raise AnsibleParserError(
+                    "Supplied entity must be Host or Group, got %s instead"
+                    % type(entity)
+                )
+        return data
+
+
+class KeePassVars:
+    """Variables of hosts and groups from one decryption of a KeePass file
+
+    Entries are mapped to hosts and groups by one pass over the index of
+    the file, their values are read on the first ``get`` of a host or a
+    group.
+    """
+
+    def __init__(
+        self,
+        dbx,
+        kdbx_key,
+        password,
+        group=None,
+        tags=True,
+        properties=keepass_socket.EXPORT_PROPERTIES,
+        prefix="",
+        compact=False,
+    ):
+        self.properties = list(properties)
+        self.prefix = prefix
+        self.database = keepass_socket.KeePassDatabase(
+            dbx, kdbx_key, watch=0, compact=compact
+        )
+        try:
+            self.database.unlock(password or None)
+        except keepass_socket.CredentialsError:
+            raise AnsibleParserError("KeePass: wrong password of '%s'" % dbx)
+        except Exception as e:
+            raise AnsibleParserError("KeePass: %s" % e)
+
+        # (kind, name) -> {variable name: position of the entry in the index}
+        self.entries = {}
+        # (kind, name) -> variables with values
+        self._vars = {}
+
+        index = self.database.index
+        if group:
+            self._map_groups(index, keepass_socket.path_key(group))
+        if tags:
+            self._map_tags(index)
+
+    def _map_groups(self, index, group):
+        subgroups = index.groups.get(group)
+        if subgroups is None:
+            return
+        for kind_group in subgroups[1]:
+            kind = GROUP_KINDS.get(kind_group[-1])
+            if kind is None:
+                continue
+            for name_group in index.groups[kind_group][1]:
+                for position in index.groups[name_group][0]:
+                    self._add(index, kind, name_group[-1], position)
+
+    def _map_tags(self, index):
+        for tag, positions in index.tags.items():
+            for prefix, kind in TAG_KINDS.items():
+                if tag.startswith(prefix) and len(tag) > len(prefix):
+                    for position in positions:
+                        self._add(index, kind, tag[len(prefix):], position)
+
+    def _add(self, index, kind, name, position):
+        entry = index.entries[position][1]
+        status, title = index.value(entry, "title")
+        if status != 0 or not title:
+            return
+        variable = self.prefix + INVALID_NAME_CHARS.sub("_", title)
+        # the first entry wins, entries of the group before tagged ones
+        self.entries.setdefault((kind, name), {}).setdefault(variable, position)
+
+    def get(self, kind, name):
+        """Variables of a host (kind ``host``) or a group (``group``)"""
+        key = (kind, name)
+        variables = self._vars.get(key)
+        if variables is None:
+            variables = self._vars[key] = self._read(self.entries.get(key, {}))
+        return variables
+
+    def _read(self, entries):
+        index = self.database.index
+        variables = {}
+        for variable, position in entries.items():
+            path, entry = index.entries[position]
+            status, item = self.database.properties(index, entry, self.properties)
+            if status != 0:
+                raise AnsibleParserError(
+                    "KeePass: entry '%s' of variable '%s': %s" % (path, variable, item)
+                )
+            error = item.pop("error", None)
+            if error is not None:
+                # a broken reference fails one property, not the host
+                display.warning(
+                    "KeePass: entry '%s' of variable '%s': %s" % (path, variable, error)
+                )
+            variables[variable] = wrap_var(item)
+        return variables
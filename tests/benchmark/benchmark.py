@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""Benchmark of the KeePass lookup and socket
+
+A KeePass file of a given size is generated, then forked clients (as
+Ansible forks) fetch random entries through ``LookupModule`` from one
+socket started by the first lookup. Nothing but the local machine is used.
+
+Reported are decryption time (pykeepass only and the first lookup, which
+starts the socket), fetch latency percentiles per lookup, throughput and
+memory of the socket. With ``--backend inprocess`` every client decrypts
+the file itself on its first lookup, there is no socket.
+
+    python benchmark.py --entries 10000 --clients 16 --requests 500
+    python benchmark.py --mode mfetch --batch 50 --json > result.json
+"""
+
+import argparse
+import json
+import os
+import random
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+
+from pykeepass import PyKeePass, create_database
+
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../plugins/lookup"),
+)
+
+import keepass  # noqa: E402
+
+PASSWORD = "benchmark"
+PERCENTILES = (50, 95, 99)
+
+
+def generate(
+    path,
+    entries=1000,
+    depth=3,
+    fanout=4,
+    attachments=0,
+    attachment_size=4096,
+    kdf_iterations=None,
+    kdf_memory=None,
+):
+    """Generate a KeePass file
+
+    Entries are spread over a tree of groups ``depth`` levels deep with
+    ``fanout`` subgroups per group, the first ``attachments`` entries get
+    an attachment of random data.
+
+    :param int kdf_iterations: Argon2 iterations, default of pykeepass if None
+    :param int kdf_memory: Argon2 memory in KiB, default of pykeepass if None
+    :return: list of entry paths and list of paths of entries with attachments
+    """
+    kp = create_database(path, password=PASSWORD)
+
+    kdf = kp.kdbx.header.value.dynamic_header.kdf_parameters.data.dict
+    if kdf_iterations is not None:
+        kdf["I"].value = kdf_iterations
+    if kdf_memory is not None:
+        kdf["M"].value = kdf_memory * 1024
+    if kdf_iterations is not None or kdf_memory is not None:
+        # the raw header is written as read unless it is dropped
+        del kp.kdbx.header["data"]
+
+    groups = [(kp.root_group, "")]
+    level = groups
+    for d in range(depth):
+        next_level = []
+        for group, group_path in level:
+            for i in range(fanout):
+                name = "group-%d-%d" % (d, i)
+                next_level.append(
+                    (kp.add_group(group, name), group_path + name + "/")
+                )
+        groups.extend(next_level)
+        level = next_level
+
+    paths = []
+    attachment_paths = []
+    for i in range(entries):
+        group, group_path = groups[i % len(groups)]
+        title = "entry-%d" % i
+        entry = kp.add_entry(
+            group,
+            title,
+            "user-%d" % i,
+            secrets.token_urlsafe(24),
+            url="https://host-%d.example.com" % i,
+        )
+        paths.append(group_path + title)
+        if i < attachments:
+            binary_id = kp.add_binary(os.urandom(attachment_size))
+            entry.add_attachment(binary_id, "attachment-%d.bin" % i)
+            attachment_paths.append(paths[-1])
+
+    kp.save()
+    return paths, attachment_paths
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def lookup_module():
+    loader = DataLoader()
+    return keepass.LookupModule(loader=loader, templar=Templar(loader=loader))
+
+
+def client(variables, queries, go_fd, result_fd):
+    """Run lookups in a forked process and write latencies (ns) as JSON"""
+    lookup = lookup_module()
+    os.read(go_fd, 1)
+    latencies = []
+    errors = 0
+    for terms in queries:
+        start = time.perf_counter_ns()
+        try:
+            lookup.run(terms, variables)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter_ns() - start)
+
+    data = json.dumps({"latencies": latencies, "errors": errors}).encode()
+    with os.fdopen(result_fd, "wb") as f:
+        f.write(data)
+
+
+def run_clients(variables, client_queries):
+    """Fork a client per list of queries, all start at once
+
+    :return: latencies of all lookups, number of errors and wall time in seconds
+    """
+    go_r, go_w = os.pipe()
+    children = []
+    for queries in client_queries:
+        result_r, result_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                os.close(go_w)
+                os.close(result_r)
+                client(variables, queries, go_r, result_w)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        os.close(result_w)
+        children.append((pid, result_r))
+    os.close(go_r)
+
+    start = time.perf_counter()
+    # closed pipe wakes all clients up
+    os.close(go_w)
+
+    latencies = []
+    errors = 0
+    for pid, result_r in children:
+        with os.fdopen(result_r, "rb") as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        if not data:
+            errors += 1
+            continue
+        result = json.loads(data)
+        latencies.extend(result["latencies"])
+        errors += result["errors"]
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return latencies, errors, wall
+
+
+def make_queries(args, paths, attachment_paths, seed):
+    rnd = random.Random(seed)
+    queries = []
+    for _ in range(args.requests):
+        if args.mode == "mfetch":
+            batch = [[rnd.choice(paths), "password"] for _ in range(args.batch)]
+            queries.append([batch])
+        elif args.mode == "attachment":
+            i = rnd.randrange(len(attachment_paths))
+            queries.append(
+                [attachment_paths[i], "attachments", "attachment-%d.bin" % i]
+            )
+        else:
+            queries.append([rnd.choice(paths), "password"])
+    return queries
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--entries", type=int, default=1000)
+    arg_parser.add_argument("--depth", type=int, default=3)
+    arg_parser.add_argument("--fanout", type=int, default=4)
+    arg_parser.add_argument("--attachments", type=int, default=0)
+    arg_parser.add_argument("--attachment-size", type=int, default=4096)
+    arg_parser.add_argument("--kdf-iterations", type=int, default=None)
+    arg_parser.add_argument("--kdf-memory", type=int, default=None, help="KiB")
+    arg_parser.add_argument("--clients", type=int, default=8)
+    arg_parser.add_argument("--requests", type=int, default=500, help="per client")
+    arg_parser.add_argument(
+        "--mode", choices=("fetch", "mfetch", "attachment"), default="fetch"
+    )
+    arg_parser.add_argument("--batch", type=int, default=20, help="mfetch size")
+    arg_parser.add_argument("--workers", type=int, default=None)
+    arg_parser.add_argument("--cache", type=int, default=0)
+    arg_parser.add_argument("--compact", action="store_true")
+    arg_parser.add_argument(
+        "--backend", choices=("socket", "inprocess"), default="socket"
+    )
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--json", action="store_true")
+    args = arg_parser.parse_args()
+
+    if args.mode == "attachment" and not args.attachments:
+        arg_parser.error("--mode attachment requires --attachments")
+    if args.mode == "attachment" and args.backend == "inprocess":
+        arg_parser.error("--mode attachment requires --backend socket")
+
+    tmp_dir = tempfile.mkdtemp(prefix="keepass-benchmark-")
+    kdbx = os.path.join(tmp_dir, "benchmark.kdbx")
+    variables = {
+        "keepass_dbx": kdbx,
+        "keepass_psw": PASSWORD,
+        "keepass_ttl": 60,
+        "keepass_cache": args.cache,
+        "keepass_compact": args.compact,
+        "keepass_backend": args.backend,
+    }
+    if args.workers:
+        variables["keepass_workers"] = args.workers
+
+    try:
+        start = time.perf_counter()
+        paths, attachment_paths = generate(
+            kdbx,
+            args.entries,
+            args.depth,
+            args.fanout,
+            args.attachments,
+            args.attachment_size,
+            args.kdf_iterations,
+            args.kdf_memory,
+        )
+        generate_time = time.perf_counter() - start
+        kdbx_size = os.path.getsize(kdbx)
+
+        start = time.perf_counter()
+        PyKeePass(kdbx, PASSWORD)
+        decrypt_time = time.perf_counter() - start
+
+        # the first lookup starts the socket
+        lookup = lookup_module()
+        start = time.perf_counter()
+        lookup.run([paths[0], "password"], variables)
+        startup_time = time.perf_counter() - start
+        if args.backend == "inprocess":
+            # clients decrypt the file themselves instead of inheriting it
+            lookup.run(["quit"], variables)
+
+        client_queries = [
+            make_queries(args, paths, attachment_paths, args.seed + i)
+            for i in range(args.clients)
+        ]
+        latencies, errors, wall = run_clients(variables, client_queries)
+
+        rss_bytes = None
+        if args.backend == "socket":
+            rss_bytes = lookup.run(["stats"], variables)[0]["rss_bytes"]
+        lookup.run(["quit"], variables)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    result = {
+        "entries": args.entries,
+        "kdbx_size": kdbx_size,
+        "mode": args.mode,
+        "backend": args.backend,
+        "clients": args.clients,
+        "lookups": len(latencies),
+        "errors": errors,
+        "generate_s": generate_time,
+        "decrypt_s": decrypt_time,
+        "startup_s": startup_time,
+        "socket_rss_bytes": rss_bytes,
+        "wall_s": wall,
+        "throughput_per_s": len(latencies) / wall if wall else 0,
+    }
+    for p in PERCENTILES:
+        result["p%d_ms" % p] = percentile(latencies, p) / 1e6
+    if args.mode == "mfetch":
+        result["values_per_s"] = result["throughput_per_s"] * args.batch
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for k, v in result.items():
+            print("%-18s %s" % (k, "%.3f" % v if isinstance(v, float) else v))
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2 @@
+#!/bin/sh
+python benchmark.py "$@"